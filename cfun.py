@@ -3,107 +3,107 @@ from typing import List, Set, Dict, Tuple
 from cs202_support.base_ast import AST
 import typed_rfun
 
-@dataclass
+@dataclass(slots=True)
 class Atm(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Int(Atm):
     val: int
 
-@dataclass
+@dataclass(slots=True)
 class Bool(Atm):
     val: bool
 
-@dataclass
+@dataclass(slots=True)
 class Void(Atm):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Var(Atm):
     var: str
     typ: typed_rfun.RfunType
 
-@dataclass
+@dataclass(slots=True)
 class GlobalVal(Atm):
     val: str
 
-@dataclass
+@dataclass(slots=True)
 class Exp(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class AtmExp(Exp):
     atm: Atm
 
-@dataclass
+@dataclass(slots=True)
 class Prim(Exp):
     op: str
     args: List[Atm]
     typ: typed_rfun.RfunType
 
-@dataclass
+@dataclass(slots=True)
 class FunRef(Exp):
     label: str
 
-@dataclass
+@dataclass(slots=True)
 class Call(Exp):
     fun: Atm
     args: List[Atm]
     typ: typed_rfun.RfunType
 
 
-@dataclass
+@dataclass(slots=True)
 class Stmt(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Assign(Stmt):
     var: str
     exp: Exp
     is_vec: bool
 
-@dataclass
+@dataclass(slots=True)
 class Collect(Stmt):
     amount: int
 
-@dataclass
+@dataclass(slots=True)
 class Tail(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Return(Tail):
     exp: Exp
 
-@dataclass
+@dataclass(slots=True)
 class Goto(Tail):
     label: str
 
-@dataclass
+@dataclass(slots=True)
 class If(Tail):
     test: Exp
     then_label: str
     else_label: str
 
-@dataclass
+@dataclass(slots=True)
 class TailCall(Tail):
     fun: Atm
     args: List[Atm]
     typ: typed_rfun.RfunType
 
 
-@dataclass
+@dataclass(slots=True)
 class Seq(Tail):
     stmt: Stmt
     tail: Tail
 
-@dataclass
+@dataclass(slots=True)
 class Def(AST):
     name: str
     args: List[Tuple[str, typed_rfun.RfunType]]
     output_type: typed_rfun.RfunType
     blocks: Dict[str, Tail]
 
-@dataclass
+@dataclass(slots=True)
 class Program(AST):
     defs: List[Def]
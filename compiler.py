@@ -1,6 +1,12 @@
 from collections import OrderedDict, defaultdict
-from typing import List, Set, Dict, Tuple, DefaultDict, Union
+from contextlib import contextmanager
+from dataclasses import fields
+from typing import Callable, List, Set, Dict, Tuple, DefaultDict, Union
+import contextvars
+import hashlib
 import itertools
+import os
+import tempfile
 import textwrap
 
 from rfun_parser import *
@@ -8,19 +14,54 @@ from typed_rfun import *
 
 import sys
 
-from cs202_support.base_ast import AST, print_ast
+from cs202_support.base_ast import AST, RType, print_ast, Iterative, trampoline
 
 import cs202_support.x86exp as x86
 import cfun
 import constants
 
-gensym_num = 0
 ind = 0
 
+class Compilation:
+    """
+    The state of one run of the compiler: the counter gensym uses for fresh
+    names, a prefix for those names, and the signatures of top-level functions
+    that are not part of the program being compiled. The incremental compiler
+    (see run_compiler_incremental) compiles one definition at a time, and sets
+    extern_functions so the definition can still call the other functions of
+    its program.
+
+    Each run has its own Compilation, held in a context variable, so the names
+    generated for a program never depend on what was compiled before it in the
+    same process, or at the same time in another thread.
+    """
+    def __init__(self, prefix: str = '', extern_functions: Dict[str, FunT] = None):
+        self.gensym_num = 0
+        self.prefix = prefix
+        self.extern_functions = extern_functions if extern_functions is not None else {}
+
+current_compilation: contextvars.ContextVar = contextvars.ContextVar('current_compilation')
+
+@contextmanager
+def new_compilation(prefix: str = '', extern_functions: Dict[str, FunT] = None):
+    token = current_compilation.set(Compilation(prefix, extern_functions))
+    try:
+        yield
+    finally:
+        current_compilation.reset(token)
+
+def compilation() -> Compilation:
+    c = current_compilation.get(None)
+    if c is None:
+        # passes called directly, outside run_compiler, share one compilation
+        c = Compilation()
+        current_compilation.set(c)
+    return c
+
 def gensym(x):
-    global gensym_num
-    gensym_num = gensym_num + 1
-    return f'{x}_{gensym_num}'
+    c = compilation()
+    c.gensym_num = c.gensym_num + 1
+    return f'{c.prefix}{x}_{c.gensym_num}'
 
 def unzip2(ls):
     """
@@ -37,6 +78,30 @@ def unzip2(ls):
         xs, ys = zip(*ls)
         return list(xs), list(ys)
 
+@contextmanager
+def bind(env: Dict, x: str, v):
+    """
+    Binds x to v in env inside a with statement, and restores the binding x
+    had before (if any) when the statement ends. Nested scopes share one dict
+    this way, instead of copying the environment for every binding.
+    :param env: An environment, changed in place
+    :param x: The name to bind
+    :param v: The value to bind it to
+    """
+    if x in env:
+        old_v = env[x]
+        env[x] = v
+        try:
+            yield
+        finally:
+            env[x] = old_v
+    else:
+        env[x] = v
+        try:
+            yield
+        finally:
+            del env[x]
+
 ##################################################
 # typecheck
 ##################################################
@@ -73,7 +138,7 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
         '<=':  BoolT(),
     }
 
-    def tc_exp(e: RfunExp, env: TEnv) -> Tuple[RfunType, RfunExpT]:
+    def tc_exp(e: RfunExp, env: TEnv) -> Iterative[Tuple[RfunType, RfunExpT]]:
         if isinstance(e, Var):
             if e.var in env:
                 t = env[e.var]
@@ -87,18 +152,18 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
         elif isinstance(e, Prim):
             if e.op == '==':
                 e1, e2 = e.args
-                t1, new_e1 = tc_exp(e1, env)
-                t2, new_e2 = tc_exp(e2, env)
+                t1, new_e1 = yield tc_exp(e1, env)
+                t2, new_e2 = yield tc_exp(e2, env)
                 assert t1 == t2
                 return BoolT(), PrimTE('==', [new_e1, new_e2], BoolT())
             elif e.op == 'vector':
-                results = [tc_exp(a, env) for a in e.args]
+                results = yield [tc_exp(a, env) for a in e.args]
                 types, new_es = zip(*results)
                 t = VectorT(list(types))
                 return t, PrimTE('vector', list(new_es), t)
             elif e.op == 'vectorRef':
                 e1, e2 = e.args
-                t1, new_e1 = tc_exp(e1, env)
+                t1, new_e1 = yield tc_exp(e1, env)
                 assert isinstance(e2, Int)
                 assert isinstance(t1, VectorT)
 
@@ -107,8 +172,8 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
                 return t, PrimTE('vectorRef', [new_e1, IntTE(e2.val)], t)
             elif e.op == 'vectorSet':
                 e1, e2, e3 = e.args
-                t1, new_e1 = tc_exp(e1, env)
-                t3, new_e3 = tc_exp(e3, env)
+                t1, new_e1 = yield tc_exp(e1, env)
+                t3, new_e3 = yield tc_exp(e3, env)
                 assert isinstance(e2, Int)
                 assert isinstance(t1, VectorT)
 
@@ -118,20 +183,20 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
 
                 return VoidT(), PrimTE('vectorSet', [new_e1, IntTE(e2.val), new_e3], VoidT())
             else:
-                results = [tc_exp(a, env) for a in e.args]
+                results = yield [tc_exp(a, env) for a in e.args]
                 arg_types, new_es = zip(*results)
                 assert list(arg_types) == prim_arg_types[e.op], e
                 t = prim_output_types[e.op]
                 return t, PrimTE(e.op, list(new_es), t)
         elif isinstance(e, Let):
-            t1, new_e1 = tc_exp(e.e1, env)
-            new_env = {**env, e.x: t1}
-            t2, new_e2 = tc_exp(e.body, new_env)
+            t1, new_e1 = yield tc_exp(e.e1, env)
+            with bind(env, e.x, t1):
+                t2, new_e2 = yield tc_exp(e.body, env)
             return t2, LetTE(e.x, new_e1, new_e2)
         elif isinstance(e, If):
-            t1, new_e1 = tc_exp(e.e1, env)
-            t2, new_e2 = tc_exp(e.e2, env)
-            t3, new_e3 = tc_exp(e.e3, env)
+            t1, new_e1 = yield tc_exp(e.e1, env)
+            t2, new_e2 = yield tc_exp(e.e2, env)
+            t3, new_e3 = yield tc_exp(e.e3, env)
 
             assert t1 == BoolT()
             assert t2 == t3
@@ -139,11 +204,11 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
 
         elif isinstance(e, Funcall):
             # Implement question 1
-            t_fun, new_fun = tc_exp(e.fun, env)
+            t_fun, new_fun = yield tc_exp(e.fun, env)
             assert isinstance(t_fun, FunT), t_fun
             new_arg_list = []
             for i in range(len(e.args)):
-                arg_type, new_arg = tc_exp(e.args[i], env)
+                arg_type, new_arg = yield tc_exp(e.args[i], env)
                 if isinstance(e.fun, Var) and e.fun.var in env:
                     assert arg_type == env[e.fun.var].arg_types[i]
                 elif isinstance(e.fun, FunT) and e.fun.fun.var in env:
@@ -170,7 +235,7 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
             initial_env[var] = type
 
         #raise Exception(initial_env)
-        t_body, new_body = tc_exp(def_body, initial_env)
+        t_body, new_body = trampoline(tc_exp(def_body, initial_env))
         assert t_body == defn.output_type
         return RfunDefT(defn.name, defn.args, defn.output_type, new_body)
 
@@ -179,7 +244,7 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
 
 
     # Handle the fact that functions can call each other
-    initial_env = {}
+    initial_env = dict(compilation().extern_functions)
     for item in defs:
         list_types = []
         for arg in item.args:
@@ -188,152 +253,595 @@ def typecheck(p: RfunProgram) -> RfunProgramT:
         initial_env[item.name] = FunT(list_types, item.output_type)
 
     new_defs = [tc_def(d) for d in defs]
-    typ_body, new_body = tc_exp(program_body, initial_env)
+    typ_body, new_body = trampoline(tc_exp(program_body, initial_env))
     return RfunProgramT(new_defs, new_body)
 
 ##################################################
-# shrink
+# rewriting
 ##################################################
 
-def shrink(p: RfunProgramT) -> RfunProgramT:
+class Rewriter:
     """
-    Eliminates some operators from Rfun
-    :param e: The Rfun program to shrink
-    :return: A shrunken Rfun program
+    A pass over the typed AST, written as rules for rewrite_program to apply
+    at each node. Several rewriters can share one traversal of the program:
+    at each node, each rewriter's rule sees the node as the rewriters before
+    it have left it. A rule may build new nodes around the children of the
+    node it is given; the rewriters after it then visit the new nodes, but
+    not those children, which they have already visited.
+
+    Each rule runs after the children of its node have been rewritten by all
+    of the rewriters, including the ones after it. So running [r1, r2] in one
+    traversal gives the same program as running r1 over the whole program
+    and then r2 only if the rules of r1 do not depend on what r2 does to the
+    children, r1 does not collect facts about a subtree that a later rule of
+    r1 throws away, and r2 does not call gensym in such a subtree (which
+    would change the names made after it). Only passes that satisfy this are
+    fused (see rewrite_passes), which is why uniquify runs before the passes
+    that throw subtrees away.
     """
-    # every time: write a new function in your pass to handle definitions
-    def shrink_def(defn: RfunDefT) -> RfunDefT:
-        new_body = shrink_exp(defn.body)
-        return RfunDefT(defn.name, defn.args, defn.output_type, new_body)
 
-    def shrink_exp(e: RfunExpT) -> RfunExpT:
-        if isinstance(e, (IntTE, BoolTE, VarTE)):
+    def __init__(self):
+        self.scopes = []
+
+    def enter_scope(self, env: Dict, x: str, v):
+        """
+        Binds x to v in env (with bind) until the matching exit_scope. For
+        rewriters that keep an environment, to call from bind and unbind.
+        """
+        scope = bind(env, x, v)
+        scope.__enter__()
+        self.scopes.append(scope)
+
+    def exit_scope(self):
+        self.scopes.pop().__exit__(None, None, None)
+
+    def start_def(self, args: List[Tuple[str, RfunType]]) -> List[Tuple[str, RfunType]]:
+        """
+        Called before the body of each definition, and with no arguments
+        before the program's body.
+        :param args: The arguments of the definition
+        :return: The new arguments of the definition
+        """
+        return args
+
+    def bind(self, x: str, e1: RfunExpT) -> str:
+        """
+        Called before the body of a let.
+        :param x: The variable the let binds
+        :param e1: The (rewritten) expression bound to x
+        :return: The new name of the variable
+        """
+        return x
+
+    def unbind(self, x: str):
+        """
+        Called after the body of a let, with the x passed to bind.
+        """
+        pass
+
+    def rewrite(self, e: RfunExpT) -> RfunExpT:
+        """
+        Called on each node, after its children have been rewritten.
+        :param e: An expression
+        :return: The rewritten expression, or e itself if it does not change
+        """
+        return e
+
+def rewrite_program(p: RfunProgramT, rewriters: List[Rewriter]) -> RfunProgramT:
+    """
+    Runs several rewriters over a program in a single traversal. Nodes whose
+    children do not change are kept as they are, instead of being copied.
+    :param p: A typed Rfun program
+    :param rewriters: The rewriters, in the order their passes would run
+    :return: The rewritten program
+    """
+    new_defs = [rewrite_def(d, rewriters) for d in p.defs]
+    for r in rewriters:
+        r.start_def([])
+    new_body = trampoline(rewrite_exp(p.body, rewriters, 0, ()))
+    return RfunProgramT(new_defs, new_body)
+
+def rewrite_def(defn: RfunDefT, rewriters: List[Rewriter]) -> RfunDefT:
+    """
+    Runs several rewriters over one definition, like rewrite_program.
+    """
+    new_args = defn.args
+    for r in rewriters:
+        new_args = r.start_def(new_args)
+    new_body = trampoline(rewrite_exp(defn.body, rewriters, 0, ()))
+
+    if new_args == defn.args and new_body is defn.body:
+        return defn
+    return RfunDefT(defn.name, new_args, defn.output_type, new_body)
+
+def rewrite_exp(e: RfunExpT, rewriters: List[Rewriter], start: int, done: Tuple) -> Iterative[RfunExpT]:
+    """
+    Rewrites an expression with rewriters[start:], leaving the nodes in done
+    as they are.
+    """
+    if done and any(e is d for d in done):
+        return e
+
+    if isinstance(e, (IntTE, BoolTE, VoidTE, VarTE, GlobalValTE, FunRefTE)):
+        new_e = e
+    elif isinstance(e, LetTE):
+        new_e1 = yield rewrite_exp(e.e1, rewriters, start, done)
+        names = [e.x]
+        for r in rewriters[start:]:
+            names.append(r.bind(names[-1], new_e1))
+        new_body = yield rewrite_exp(e.body, rewriters, start, done)
+        for r, x in reversed(list(zip(rewriters[start:], names))):
+            r.unbind(x)
+
+        if names[-1] == e.x and new_e1 is e.e1 and new_body is e.body:
+            new_e = e
+        else:
+            new_e = LetTE(names[-1], new_e1, new_body)
+    elif isinstance(e, PrimTE):
+        new_args = yield [rewrite_exp(a, rewriters, start, done) for a in e.args]
+        if all(a is b for a, b in zip(new_args, e.args)):
+            new_e = e
+        else:
+            new_e = PrimTE(e.op, new_args, e.typ)
+    elif isinstance(e, IfTE):
+        new_e1, new_e2, new_e3 = yield [rewrite_exp(e.e1, rewriters, start, done),
+                                        rewrite_exp(e.e2, rewriters, start, done),
+                                        rewrite_exp(e.e3, rewriters, start, done)]
+        if new_e1 is e.e1 and new_e2 is e.e2 and new_e3 is e.e3:
+            new_e = e
+        else:
+            new_e = IfTE(new_e1, new_e2, new_e3, e.typ)
+    elif isinstance(e, FuncallTE):
+        new_args = yield [rewrite_exp(a, rewriters, start, done) for a in e.args]
+        new_fun = yield rewrite_exp(e.fun, rewriters, start, done)
+        if new_fun is e.fun and all(a is b for a, b in zip(new_args, e.args)):
+            new_e = e
+        else:
+            new_e = FuncallTE(new_fun, new_args, e.typ)
+    else:
+        raise Exception('rewrite_exp', e)
+
+    for i in range(start, len(rewriters)):
+        result = rewriters[i].rewrite(new_e)
+        if result is not new_e:
+            if i + 1 == len(rewriters):
+                return result
+            # the later rewriters still have to visit the nodes the rule built
+            return (yield rewrite_exp(result, rewriters, i + 1, exp_children(new_e)))
+
+    return new_e
+
+def exp_children(e: RfunExpT) -> Tuple:
+    if isinstance(e, LetTE):
+        return (e.e1, e.body)
+    elif isinstance(e, PrimTE):
+        return tuple(e.args)
+    elif isinstance(e, IfTE):
+        return (e.e1, e.e2, e.e3)
+    elif isinstance(e, FuncallTE):
+        return tuple(e.args) + (e.fun,)
+    else:
+        return ()
+
+##################################################
+# inline-functions
+##################################################
+
+# Definitions whose bodies have at most inline_max_size nodes are inlined, and
+# at most inline_fuel calls are inlined in a program, so that inlining cannot
+# make the code grow without bound
+inline_max_size = 40
+inline_fuel = 1000
+
+def exp_size(e: RfunExpT) -> int:
+    """
+    Counts the nodes of an expression.
+    """
+    size = 0
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        size += 1
+        todo.extend(exp_children(e))
+    return size
+
+def referenced_names(e: RfunExpT) -> Set[str]:
+    """
+    Finds the names of all the variables an expression refers to.
+    """
+    names = set()
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, VarTE):
+            names.add(e.var)
+        todo.extend(exp_children(e))
+    return names
+
+def call_graph_order(calls: Dict[str, Set[str]]) -> Tuple[List[str], Set[str]]:
+    """
+    Orders the functions of a call graph so that each one comes after the
+    functions it calls, except for functions that call each other, and finds
+    the recursive functions. (This is Tarjan's algorithm for strongly
+    connected components, with an explicit stack.)
+    :param calls: A dict mapping each function to the functions it refers to
+    :return: A Tuple. The first element lists the functions in order, the
+    second is the set of recursive functions.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    order = []
+    recursive = set()
+
+    def visit(f: str):
+        index[f] = low[f] = len(index)
+        stack.append(f)
+        on_stack.add(f)
+        work.append((f, iter(sorted(calls[f]))))
+
+    for root in calls:
+        if root in index:
+            continue
+
+        work = []
+        visit(root)
+        while work:
+            f, callees = work[-1]
+            for g in callees:
+                if g not in index:
+                    visit(g)
+                    break
+                elif g in on_stack:
+                    low[f] = min(low[f], index[g])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[f])
+
+                if low[f] == index[f]:
+                    # f and the functions above it on the stack call each other
+                    component = []
+                    while True:
+                        g = stack.pop()
+                        on_stack.remove(g)
+                        component.append(g)
+                        if g == f:
+                            break
+
+                    order.extend(component)
+                    if len(component) > 1 or f in calls[f]:
+                        recursive.update(component)
+
+    return order, recursive
+
+class Inline(Rewriter):
+    def __init__(self, p: RfunProgramT):
+        super().__init__()
+
+        # copies the bodies of inlined functions, with fresh names for their
+        # arguments and variables
+        self.uniquify = Uniquify(p)
+
+        # Maps inlinable functions to their definitions, and to the
+        # functions their bodies refer to
+        self.inlinable = {}
+        self.calls = {}
+
+        # The local variables in scope
+        self.locals = {}
+        self.fuel = inline_fuel
+
+    def add(self, defn: RfunDefT, recursive: bool):
+        if not recursive and exp_size(defn.body) <= inline_max_size:
+            self.inlinable[defn.name] = defn
+            self.calls[defn.name] = referenced_names(defn.body) & self.uniquify.functions.keys()
+
+    def start_def(self, args):
+        self.locals = {x: True for x, t in args}
+        return args
+
+    def bind(self, x, e1):
+        self.enter_scope(self.locals, x, True)
+        return x
+
+    def unbind(self, x):
+        self.exit_scope()
+
+    def shadowed(self, name: str) -> bool:
+        return name in self.locals
+
+    def rewrite(self, e):
+        if isinstance(e, FuncallTE) and isinstance(e.fun, VarTE) and \
+                e.fun.var in self.inlinable and not self.shadowed(e.fun.var) and self.fuel > 0:
+            # the copy of the body must still refer to the same functions
+            if any(self.shadowed(g) for g in self.calls[e.fun.var]):
+                return e
+
+            self.fuel = self.fuel - 1
+            copy = rewrite_def(self.inlinable[e.fun.var], [self.uniquify])
+            bindings = {x: a for (x, t), a in zip(copy.args, e.args)}
+            return mk_let(bindings, copy.body)
+        else:
             return e
-        elif isinstance(e, LetTE):
-            new_e1 = shrink_exp(e.e1)
-            new_body = shrink_exp(e.body)
-            return LetTE(e.x, new_e1, new_body)
-        elif isinstance(e, PrimTE):
-            new_args = [shrink_exp(arg) for arg in e.args]
 
+def inline_functions(p: RfunProgramT) -> RfunProgramT:
+    """
+    Inlines calls to small functions that are not recursive: each call becomes
+    a sequence of lets binding the function's arguments, around a copy of its
+    body. Functions are handled after the functions they call, so the bodies
+    they inline have had their own calls inlined already.
+    :param p: A typed Rfun program
+    :return: An equivalent Rfun program, with small functions inlined
+    """
+    defs = {d.name: d for d in p.defs}
+    calls = {d.name: referenced_names(d.body) & defs.keys() for d in p.defs}
+    order, recursive = call_graph_order(calls)
+
+    inliner = Inline(p)
+    for name in order:
+        defs[name] = rewrite_def(defs[name], [inliner])
+        inliner.add(defs[name], name in recursive)
+
+    new_defs = [defs[d.name] for d in p.defs]
+    inliner.start_def([])
+    new_body = trampoline(rewrite_exp(p.body, [inliner], 0, ()))
+    return RfunProgramT(new_defs, new_body)
+
+##################################################
+# shrink
+##################################################
+
+class Shrink(Rewriter):
+    def rewrite(self, e: RfunExpT) -> RfunExpT:
+        if isinstance(e, PrimTE):
             if e.op in ['+', 'not', '==', '<', 'vector', 'vectorRef', 'vectorSet', 'neg']:
-                return PrimTE(e.op, new_args, e.typ)
+                return e
             elif e.op == '>':
-                return PrimTE('<', [new_args[1], new_args[0]], BoolT())
+                return PrimTE('<', [e.args[1], e.args[0]], BoolT())
             elif e.op == '<=':
                 return PrimTE('not',
-                              [PrimTE('<', [new_args[1], new_args[0]], BoolT())], BoolT())
+                              [PrimTE('<', [e.args[1], e.args[0]], BoolT())], BoolT())
             elif e.op == '>=':
                 return PrimTE('not',
-                              [PrimTE('<', new_args, BoolT())], BoolT())
+                              [PrimTE('<', e.args, BoolT())], BoolT())
             elif e.op == '&&':
-                e1, e2 = new_args
+                e1, e2 = e.args
                 return IfTE(e1, e2, BoolTE(False), BoolT())
             elif e.op == '||':
-                e1, e2 = new_args
+                e1, e2 = e.args
                 return IfTE(e1, BoolTE(True), e2, BoolT())
             else:
                 raise Exception('shrink unknown prim:', e)
-        elif isinstance(e, IfTE):
-            return IfTE(shrink_exp(e.e1),
-                        shrink_exp(e.e2),
-                        shrink_exp(e.e3),
-                        e.typ)
-
-        elif isinstance(e, FuncallTE):
-            new_args = []
-            for arg in e.args:
-                new_args.append(shrink_exp(arg))
-            return FuncallTE(shrink_exp(e.fun), new_args, e.typ)
         else:
-            raise Exception('shrink', e)
-
-    prog_body = p.body
-    prog_defns = p.defs
-    new_defs = [shrink_def(d) for d in prog_defns]
-    new_body = shrink_exp(prog_body)
-    return RfunProgramT(new_defs, new_body)
-
-
+            return e
 
-    
+def shrink(p: RfunProgramT) -> RfunProgramT:
+    """
+    Eliminates some operators from Rfun
+    :param e: The Rfun program to shrink
+    :return: A shrunken Rfun program
+    """
+    return rewrite_program(p, [Shrink()])
 
 ##################################################
-# uniquify
+# fold-constants
 ##################################################
 
-def uniquify(p: RfunProgramT) -> RfunProgramT:
-    """
-    Makes the program's variable names unique
-    :param e: The Rfun program to uniquify
-    :return: An Rfun program with unique names
-    """
-    def uniquify_def(defn: RfunDefT) -> RfunDefT:
-        # need to uniquify the arguments to the function
-        # gensym new names for arguments
-        # create a new environment that maps arguments to their new names
-        # use it when we call uniquify_exp
+# 64-bit words, which the arithmetic of the compiled code wraps around
+word_min = -2**63
+word_max = 2**63 - 1
 
-        # Create type environment
-        names_env = {}
-        for arg in defn.args:
-            var, type = arg
-            names_env[var] = gensym(var)
+class FoldConstants(Rewriter):
+    def __init__(self):
+        super().__init__()
 
-        new_bod = uniquify_exp(defn.body, names_env)
-        #raise Exception(defn.args)
-        new_args = [(names_env[a], t) for a,t in defn.args]
+        # Maps variables bound to constants to the constants, and shadowed
+        # variables to None
+        self.env = {}
 
-        return RfunDefT(defn.name, new_args, defn.output_type, new_bod)
+    def start_def(self, args):
+        self.env = {}
+        return args
 
-    def uniquify_exp(e: RfunExpT, env: Dict[str, str]) -> RfunExpT:
-        if isinstance(e, (IntTE, BoolTE)):
+    def bind(self, x, e1):
+        self.enter_scope(self.env, x, e1 if isinstance(e1, (IntTE, BoolTE)) else None)
+        return x
+
+    def unbind(self, x):
+        self.exit_scope()
+
+    def rewrite(self, e):
+        if isinstance(e, VarTE):
+            # Propagate constants bound by lets
+            if self.env.get(e.var) is not None:
+                return self.env[e.var]
             return e
-        elif isinstance(e, VarTE):
-            if e.var in env:
-                return VarTE(env[e.var], e.typ)
-            elif e.var in initial_env:
-                return VarTE(initial_env[e.var], e.typ)
         elif isinstance(e, LetTE):
-            new_e1 = uniquify_exp(e.e1, env)
-            new_x = gensym(e.x)
-            new_env = {**env, e.x: new_x}
-            new_body = uniquify_exp(e.body, new_env)
-            return LetTE(new_x, new_e1, new_body)
+            # Every use of the variable has been replaced by the constant
+            if isinstance(e.e1, (IntTE, BoolTE)):
+                return e.body
+            return e
         elif isinstance(e, PrimTE):
-            new_args = [uniquify_exp(arg, env) for arg in e.args]
-            return PrimTE(e.op, new_args, e.typ)
+            return self.fold_prim(e)
         elif isinstance(e, IfTE):
-            return IfTE(uniquify_exp(e.e1, env),
-                        uniquify_exp(e.e2, env),
-                        uniquify_exp(e.e3, env),
-                        e.typ)
-        elif isinstance(e, FuncallTE):
-            #raise Exception(e)
-            new_arg = [uniquify_exp(a, env) for a in e.args]
-            return FuncallTE(uniquify_exp(e.fun, env), new_arg, e.typ)
+            # Prune branches that can never run
+            if isinstance(e.e1, BoolTE):
+                return e.e2 if e.e1.val else e.e3
+            elif isinstance(e.e2, BoolTE) and isinstance(e.e3, BoolTE) and \
+                    e.e2.val and not e.e3.val:
+                return e.e1
+            return e
+        else:
+            return e
 
+    def fold_prim(self, e: PrimTE) -> RfunExpT:
+        args = e.args
+        ints = all(isinstance(a, IntTE) for a in args)
+        bools = all(isinstance(a, BoolTE) for a in args)
+
+        if e.op == '+':
+            if ints and word_min <= args[0].val + args[1].val <= word_max:
+                return IntTE(args[0].val + args[1].val)
+            elif isinstance(args[0], IntTE) and args[0].val == 0:
+                return args[1]
+            elif isinstance(args[1], IntTE) and args[1].val == 0:
+                return args[0]
+        elif e.op == 'neg':
+            if ints and word_min <= -args[0].val <= word_max:
+                return IntTE(-args[0].val)
+        elif e.op == 'not':
+            if bools:
+                return BoolTE(not args[0].val)
+            elif isinstance(args[0], PrimTE) and args[0].op == 'not':
+                return args[0].args[0]
+        elif e.op == '==':
+            if ints or bools:
+                return BoolTE(args[0].val == args[1].val)
+        elif e.op == '<':
+            if ints:
+                return BoolTE(args[0].val < args[1].val)
+
+        return e
+
+def fold_constants(p: RfunProgramT) -> RfunProgramT:
+    """
+    Evaluates the parts of the program that only depend on constants: folds
+    arithmetic and comparisons over literals, replaces variables bound to
+    constants with the constants, and removes the branches of conditionals
+    whose condition is constant.
+    :param p: A shrunken Rfun program
+    :return: An equivalent Rfun program
+    """
+    return rewrite_program(p, [FoldConstants()])
+
+##################################################
+# uniquify
+##################################################
+
+class Uniquify(Rewriter):
+    def __init__(self, p: RfunProgramT):
+        super().__init__()
+
+        # Handle the fact that functions can call each other
+        self.functions = {name: name for name in compilation().extern_functions}
+        for item in p.defs:
+            self.functions[item.name] = item.name
+
+        self.env = {}
+
+    def start_def(self, args):
+        # gensym new names for arguments, and use them in the body
+        self.env = dict(self.functions)
+        new_args = []
+        for var, t in args:
+            self.env[var] = gensym(var)
+            new_args.append((self.env[var], t))
+        return new_args
+
+    def bind(self, x, e1):
+        new_x = gensym(x)
+        self.enter_scope(self.env, x, new_x)
+        return new_x
+
+    def unbind(self, x):
+        self.exit_scope()
+
+    def rewrite(self, e):
+        if isinstance(e, VarTE) and e.var in self.env and self.env[e.var] != e.var:
+            return VarTE(self.env[e.var], e.typ)
         else:
-            raise Exception('uniquify', e)
+            return e
 
-    prog_body = p.body
-    prog_defns = p.defs
+def uniquify(p: RfunProgramT) -> RfunProgramT:
+    """
+    Makes the program's variable names unique
+    :param e: The Rfun program to uniquify
+    :return: An Rfun program with unique names
+    """
+    return rewrite_program(p, [Uniquify(p)])
 
-    # Handle the fact that functions can call each other
-    initial_env = {}
-    for item in prog_defns:
-        initial_env[item.name] = item.name
+##################################################
+# remove-dead-lets
+##################################################
 
-    new_defs = [uniquify_def(d) for d in prog_defns]
-    new_body = uniquify_exp(prog_body, initial_env)
-    return RfunProgramT(new_defs, new_body)
+# Primitives with side effects, which must run even if their result is unused
+effect_ops = ['vectorSet', 'collect']
 
+def pure_reads(e: RfunExpT) -> Union[List[str], None]:
+    """
+    Finds the variables read by an expression without side effects.
+    :param e: An expression
+    :return: The names of the variables e reads, once per read, or None if e
+    may have side effects (it sets a vector element, runs the collector, or
+    calls a function)
+    """
+    reads = []
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, FuncallTE):
+            return None
+        elif isinstance(e, PrimTE) and e.op in effect_ops:
+            return None
+        elif isinstance(e, VarTE):
+            reads.append(e.var)
+        todo.extend(exp_children(e))
+    return reads
 
+class RemoveDeadLets(Rewriter):
+    def __init__(self):
+        super().__init__()
+
+        # Counts the reads of each variable. Variable names are unique after
+        # uniquify, so there is no need to track scopes.
+        self.reads = defaultdict(int)
+
+    def rewrite(self, e):
+        if isinstance(e, VarTE):
+            self.reads[e.var] += 1
+        elif isinstance(e, LetTE) and self.reads[e.x] == 0:
+            # the body has been visited, so it never reads the variable
+            reads = pure_reads(e.e1)
+            if reads is not None:
+                for x in reads:
+                    self.reads[x] -= 1
+                return e.body
+        return e
+
+def remove_dead_lets(p: RfunProgramT) -> RfunProgramT:
+    """
+    Removes the lets that bind variables that are never read to expressions
+    without side effects. Must run after uniquify. Runs as a traversal of its
+    own, never fused (see rewrite_passes): after fold constants, so that reads
+    in branches it drops are not counted, and before expose allocation, which
+    turns the vectors bound by lets into writes to memory.
+    :param p: An Rfun program with unique variable names
+    :return: An equivalent Rfun program, without dead lets
+    """
+    return rewrite_program(p, [RemoveDeadLets()])
 
 ##################################################
 # reveal_functions
 ##################################################
 
+class RevealFunctions(Rewriter):
+    def __init__(self, p: RfunProgramT):
+        super().__init__()
+
+        # Set of names of functions
+        self.functions = set(compilation().extern_functions)
+        for item in p.defs:
+            self.functions.add(item.name)
+
+    def rewrite(self, e):
+        if isinstance(e, VarTE) and e.var in self.functions and isinstance(e.typ, FunT):
+            return FunRefTE(e.var, e.typ)
+        else:
+            return e
+
 def reveal_functions(p: RfunProgramT) -> RfunProgramT:
     """
     Transform references to top-level functions from variable references to
@@ -342,150 +850,69 @@ def reveal_functions(p: RfunProgramT) -> RfunProgramT:
     :return: An Rfun program in which all references to top-level functions
     are in the form of FunRef objects.
     """
-
-    def reveal_functions_def(defn: RfunDefT) -> RfunDefT:
-
-        new_bod = reveal_functions_exp(defn.body, env_top_level)
-        #new_args = [reveal_functions_exp(a, env_top_level) for a,t in defn.args]
-
-        return RfunDefT(defn.name, defn.args, defn.output_type, new_bod)
-
-    def reveal_functions_exp(e: RfunExpT, env: Set[str]) -> RfunExpT:
-        if isinstance(e, (IntTE, BoolTE)):
-            return e
-        elif isinstance(e, VarTE):
-            if e.var in env:
-                if isinstance(e.typ, FunT):
-                    return FunRefTE(e.var, e.typ)
-            else:
-                return e
-        elif isinstance(e, LetTE):
-            new_e1 = reveal_functions_exp(e.e1, env)
-            new_body = reveal_functions_exp(e.body, env)
-            return LetTE(e.x, new_e1, new_body)
-        elif isinstance(e, PrimTE):
-            new_args = [reveal_functions_exp(arg, env) for arg in e.args]
-            return PrimTE(e.op, new_args, e.typ)
-        elif isinstance(e, IfTE):
-            return IfTE(reveal_functions_exp(e.e1, env),
-                        reveal_functions_exp(e.e2, env),
-                        reveal_functions_exp(e.e3, env),
-                        e.typ)
-        elif isinstance(e, FuncallTE):
-            #raise Exception(e)
-            new_arg = [reveal_functions_exp(a, env) for a in e.args]
-            return FuncallTE(reveal_functions_exp(e.fun, env), new_arg, e.typ)
-
-        else:
-            raise Exception('uniquify', e)
-
-    prog_body = p.body
-    prog_defns = p.defs
-
-    # Set of names of functions
-    env_top_level = set()
-    for item in prog_defns:
-        env_top_level.add(item.name)
-
-    new_defs = [reveal_functions_def(d) for d in prog_defns]
-    new_body = reveal_functions_exp(prog_body, env_top_level)
-    return RfunProgramT(new_defs, new_body)
+    return rewrite_program(p, [RevealFunctions(p)])
 
 ##################################################
 # limit-functions
 ##################################################
 
+class LimitFunctions(Rewriter):
+    def __init__(self):
+        super().__init__()
 
-def limit_functions(p: RfunProgramT) -> RfunProgramT:
-    """
-    Limit functions to have at most 6 arguments.
-    :param e: An Rfun program to reveal_functions
-    :return: An Rfun program, in which each function has at most 6 arguments
-    """
+        # Maps the arguments passed in the vector to vectorRefs
+        self.env = {}
 
-    def limit_functions_def(defn: RfunDefT) -> RfunDefT:
+    def start_def(self, args):
         # Part 1
-        if len(defn.args) > 6:
-            # Do the thing
+        self.env = {}
+        if len(args) > 6:
             args_vec_name = gensym('args_vec')
-            first_five_args = defn.args[:5]
-            rest_args = defn.args[5:]
+            first_five_args = args[:5]
+            rest_args = args[5:]
             list_arg = []
             names = []
-            for str, arg in rest_args:
+            for s, arg in rest_args:
                 list_arg.append(arg)
-                names.append(str)
+                names.append(s)
 
             vect = (args_vec_name, VectorT(list_arg))
-            # Maps variables to vectorRef
-            env = dict()
-            index = 0
-            for s in names:
-                #raise Exception(list_arg)
-                env[s] = PrimTE('vectorRef', [VarTE(args_vec_name, VectorT(list_arg)), IntTE(index)], list_arg[index])
-                index += 1
-
-            new_body = limit_functions_exp(defn.body, env)
-            return RfunDefT(defn.name, first_five_args + [vect], defn.output_type, new_body)
-        else:
-            new_bod = limit_functions_exp(defn.body, {}) # The body may call other functions
-            return RfunDefT(defn.name, defn.args, defn.output_type, new_bod)
-
+            for index, s in enumerate(names):
+                self.env[s] = PrimTE('vectorRef', [VarTE(args_vec_name, VectorT(list_arg)), IntTE(index)],
+                                     list_arg[index])
 
+            return first_five_args + [vect]
+        else:
+            return args
 
-    def limit_functions_exp(e: RfunExpT, env: Dict[str, RfunExpT]) -> RfunExpT:
-        if isinstance(e, (IntTE, BoolTE, FunRefTE)):
-            return e
-        elif isinstance(e, VarTE):
-            if e.var in env:
-                return env[e.var]
-            else:
-                return e
-        elif isinstance(e, LetTE):
-            new_e1 = limit_functions_exp(e.e1, env)
-            new_body = limit_functions_exp(e.body, env)
-            return LetTE(e.x, new_e1, new_body)
-        elif isinstance(e, PrimTE):
-            new_args = [limit_functions_exp(arg, env) for arg in e.args]
-            return PrimTE(e.op, new_args, e.typ)
-        elif isinstance(e, IfTE):
-            return IfTE(limit_functions_exp(e.e1, env),
-                        limit_functions_exp(e.e2, env),
-                        limit_functions_exp(e.e3, env),
-                        e.typ)
-        elif isinstance(e, FuncallTE):
-            new_args = [limit_functions_exp(a, env) for a in e.args]
-            new_fun = limit_functions_exp(e.fun, env)
+    def rewrite(self, e):
+        if isinstance(e, VarTE) and e.var in self.env:
+            return self.env[e.var]
+        elif isinstance(e, FuncallTE) and len(e.args) > 6:
             # Part 2
-            if len(e.args) > 6:
-                # do the thing
-                first_five_args = new_args[:5]
-                rest_args = new_args[5:]
-
-                list_arg = []
-                if isinstance(new_fun, FunRefTE):
-                    if isinstance(new_fun.typ, (FunT, VarTE)):
-                        list_arg = new_fun.typ.arg_types[5:]
-
-                # Get types of the arguments
-                # Solution: Look at the function being called: It should
-                # Be either a var or FunRef and both will tell the types
-                vect_exp = PrimTE('vector', rest_args, VectorT(list_arg))
-                return FuncallTE(new_fun, first_five_args + [vect_exp], e.typ)
+            first_five_args = e.args[:5]
+            rest_args = e.args[5:]
 
-            else:
-                return FuncallTE(e.fun, new_args, e.typ)
+            # Get types of the arguments
+            # Solution: Look at the function being called: It should
+            # Be either a var or FunRef and both will tell the types
+            list_arg = []
+            if isinstance(e.fun, FunRefTE):
+                if isinstance(e.fun.typ, FunT):
+                    list_arg = e.fun.typ.arg_types[5:]
 
+            vect_exp = PrimTE('vector', rest_args, VectorT(list_arg))
+            return FuncallTE(e.fun, first_five_args + [vect_exp], e.typ)
         else:
-            raise Exception('limit_function', e)
-
-    prog_body = p.body
-    prog_defns = p.defs
-
-    new_defs = [limit_functions_def(d) for d in prog_defns]
-    new_body = limit_functions_exp(prog_body, {})
-    return RfunProgramT(new_defs, new_body)
+            return e
 
+def limit_functions(p: RfunProgramT) -> RfunProgramT:
+    """
+    Limit functions to have at most 6 arguments.
+    :param e: An Rfun program to reveal_functions
+    :return: An Rfun program, in which each function has at most 6 arguments
+    """
+    return rewrite_program(p, [LimitFunctions()])
 
 ##################################################
 # expose-alloc
@@ -505,6 +932,58 @@ def mk_let(bindings: Dict[str, RfunExpT], body: RfunExpT):
 
     return result
 
+class ExposeAlloc(Rewriter):
+    def rewrite(self, e):
+        if isinstance(e, PrimTE) and e.op == 'vector':
+            vec_type = e.typ
+            assert isinstance(vec_type, VectorT)
+
+            bindings = {}
+
+            # Step 1.
+            # make a name for each element of the vector
+            # bind the name to the input expression
+            var_names = [gensym('v') for _ in e.args]
+            for var, a in zip(var_names, e.args):
+                bindings[var] = a
+
+            # Step 2.
+            # run the collector if we don't have enough space
+            # to do the allocation
+            total_bytes = 8 + 8 * len(e.args)
+            bindings[gensym('_')] = \
+                IfTE(PrimTE('<', [PrimTE('+', [GlobalValTE('free_ptr'),
+                                               IntTE(total_bytes)], IntT()),
+                                  GlobalValTE('fromspace_end')], BoolT()),
+                     VoidTE(),
+                     PrimTE('collect', [IntTE(total_bytes)], VoidT()),
+                     VoidT())
+
+            # Step 3.
+            # allocate the bytes for the vector and give it a name
+            vec_name = gensym('vec')
+            bindings[vec_name] = PrimTE('allocate', [IntTE(len(e.args))], vec_type)
+
+            # Step 4.
+            # vectorSet each element of the allocated vector to its variable
+            # from Step 1
+            for idx in range(len(e.args)):
+                typ = vec_type.types[idx]
+                var = var_names[idx]
+
+                bindings[gensym('_')] = PrimTE('vectorSet',
+                                               [
+                                                   VarTE(vec_name, vec_type),
+                                                   IntTE(idx),
+                                                   VarTE(var, typ)
+                                               ],
+                                               VoidT())
+
+            # Step 5.
+            # Make a big Let with all the bindings
+            return mk_let(bindings, VarTE(vec_name, vec_type))
+        else:
+            return e
 
 def expose_alloc(p: RfunProgramT) -> RfunProgramT:
     """
@@ -513,92 +992,7 @@ def expose_alloc(p: RfunProgramT) -> RfunProgramT:
     :param e: A typed Rfun expression
     :return: A typed Rfun expression, without 'vector' forms
     """
-    def expose_alloc_def(defn: RfunDefT) -> RfunDefT:
-        new_bod = expose_alloc_exp(defn.body)
-        return RfunDefT(defn.name, defn.args, defn.output_type, new_bod)
-
-    def expose_alloc_exp(e: RfunExpT) -> RfunExpT:
-        if isinstance(e, (IntTE, BoolTE, VarTE)):
-            return e
-        elif isinstance(e, LetTE):
-            new_e1 = expose_alloc_exp(e.e1)
-            new_body = expose_alloc_exp(e.body)
-            return LetTE(e.x, new_e1, new_body)
-        elif isinstance(e, PrimTE):
-            new_args = [expose_alloc_exp(arg) for arg in e.args]
-
-            if e.op == 'vector':
-                vec_type = e.typ
-                assert isinstance(vec_type, VectorT)
-
-                bindings = {}
-
-                # Step 1.
-                # make a name for each element of the vector
-                # bind the name to the input expression
-                var_names = [gensym('v') for _ in new_args]
-                for var, a in zip(var_names, new_args):
-                    bindings[var] = a
-
-                # Step 2.
-                # run the collector if we don't have enough space
-                # to do the allocation
-                total_bytes = 8 + 8 * len(new_args)
-                bindings[gensym('_')] = \
-                    IfTE(PrimTE('<', [PrimTE('+', [GlobalValTE('free_ptr'),
-                                                   IntTE(total_bytes)], IntT()),
-                                      GlobalValTE('fromspace_end')], BoolT()),
-                         VoidTE(),
-                         PrimTE('collect', [IntTE(total_bytes)], VoidT()),
-                         VoidT())
-
-                # Step 3.
-                # allocate the bytes for the vector and give it a name
-                vec_name = gensym('vec')
-                bindings[vec_name] = PrimTE('allocate', [IntTE(len(new_args))], vec_type)
-
-                # Step 4.
-                # vectorSet each element of the allocated vector to its variable
-                # from Step 1
-                for idx in range(len(new_args)):
-                    typ = vec_type.types[idx]
-                    var = var_names[idx]
-
-                    bindings[gensym('_')] = PrimTE('vectorSet',
-                                                   [
-                                                       VarTE(vec_name, vec_type),
-                                                       IntTE(idx),
-                                                       VarTE(var, typ)
-                                                   ],
-                                                   VoidT())
-
-                # Step 5.
-                # Make a big Let with all the bindings
-                return mk_let(bindings, VarTE(vec_name, vec_type))
-            else:
-                return PrimTE(e.op, new_args, e.typ)
-
-        elif isinstance(e, IfTE):
-            return IfTE(expose_alloc_exp(e.e1),
-                        expose_alloc_exp(e.e2),
-                        expose_alloc_exp(e.e3),
-                        e.typ)
-
-        elif isinstance(e, FuncallTE):
-            new_fun = expose_alloc_exp(e.fun)
-            new_args = [expose_alloc_exp(a) for a in e.args]
-            return FuncallTE(new_fun, new_args, e.typ)
-        elif isinstance(e, FunRefTE):
-            return e
-        else:
-            raise Exception('expose_alloc', e)
-
-    prog_body = p.body
-    prog_defns = p.defs
-
-    new_defs = [expose_alloc_def(d) for d in prog_defns]
-    new_body = expose_alloc_exp(prog_body)
-    return RfunProgramT(new_defs, new_body)
+    return rewrite_program(p, [ExposeAlloc()])
 
 
 ##################################################
@@ -613,11 +1007,11 @@ def rco(p: RfunProgramT) -> RfunProgramT:
     :return: An Rfun expression in A-Normal Form
     """
     def rco_def(defn: RfunDefT) -> RfunDefT:
-        new_bod = rco_exp(defn.body)
+        new_bod = trampoline(rco_exp(defn.body))
         return RfunDefT(defn.name, defn.args, defn.output_type, new_bod)
 
 
-    def rco_atm(e: RfunExpT, bindings: Dict[str, RfunExpT]) -> RfunExpT:
+    def rco_atm(e: RfunExpT, bindings: Dict[str, RfunExpT]) -> Iterative[RfunExpT]:
         if isinstance(e, (IntTE, BoolTE, VarTE)):
             return e
         elif isinstance(e, GlobalValTE):
@@ -625,20 +1019,20 @@ def rco(p: RfunProgramT) -> RfunProgramT:
             bindings[new_v] = e
             return VarTE(new_v, IntT())  # all global vals are ints
         elif isinstance(e, LetTE):
-            new_e1 = rco_exp(e.e1)
+            new_e1 = yield rco_exp(e.e1)
             bindings[e.x] = new_e1
-            v = rco_atm(e.body, bindings)
+            v = yield rco_atm(e.body, bindings)
             return v
         elif isinstance(e, PrimTE):
-            new_args = [rco_atm(arg, bindings) for arg in e.args]
+            new_args = yield [rco_atm(arg, bindings) for arg in e.args]
 
             new_v = gensym('tmp')
             bindings[new_v] = PrimTE(e.op, new_args, e.typ)
             return VarTE(new_v, e.typ)
         elif isinstance(e, IfTE):
-            new_if = IfTE(rco_atm(e.e1, bindings),
-                          rco_atm(e.e2, bindings),
-                          rco_atm(e.e3, bindings),
+            new_if = IfTE((yield rco_atm(e.e1, bindings)),
+                          (yield rco_atm(e.e2, bindings)),
+                          (yield rco_atm(e.e3, bindings)),
                           e.typ)
             new_v = gensym('tmp')
             bindings[new_v] = new_if
@@ -648,8 +1042,8 @@ def rco(p: RfunProgramT) -> RfunProgramT:
             bindings[new_var] = e
             return VarTE(new_var, e.typ)
         elif isinstance(e, FuncallTE):
-            new_args = [rco_atm(a, bindings) for a in e.args]
-            new_funcall = FuncallTE(rco_atm(e.fun, bindings),
+            new_args = yield [rco_atm(a, bindings) for a in e.args]
+            new_funcall = FuncallTE((yield rco_atm(e.fun, bindings)),
                                     new_args, e.typ )
 
             new_var = gensym('tmp')
@@ -659,27 +1053,27 @@ def rco(p: RfunProgramT) -> RfunProgramT:
         else:
             raise Exception('rco_atm', e)
 
-    def rco_exp(e: RfunExpT) -> RfunExpT:
+    def rco_exp(e: RfunExpT) -> Iterative[RfunExpT]:
         if isinstance(e, (IntTE, BoolTE, VoidTE, VarTE, GlobalValTE)):
             return e
         elif isinstance(e, LetTE):
-            new_e1 = rco_exp(e.e1)
-            new_body = rco_exp(e.body)
+            new_e1 = yield rco_exp(e.e1)
+            new_body = yield rco_exp(e.body)
             return LetTE(e.x, new_e1, new_body)
         elif isinstance(e, PrimTE):
             bindings: Dict[str, RfunExpT] = {}
-            new_args = [rco_atm(arg, bindings) for arg in e.args]
+            new_args = yield [rco_atm(arg, bindings) for arg in e.args]
 
             return mk_let(bindings, PrimTE(e.op, new_args, e.typ))
         elif isinstance(e, IfTE):
-            return IfTE(rco_exp(e.e1),
-                        rco_exp(e.e2),
-                        rco_exp(e.e3),
+            return IfTE((yield rco_exp(e.e1)),
+                        (yield rco_exp(e.e2)),
+                        (yield rco_exp(e.e3)),
                         e.typ)
         elif isinstance(e, FuncallTE):
             bindings: Dict[str, RfunExpT] = {}
-            new_fun = rco_atm(e.fun, bindings)
-            new_args = [rco_atm(a, bindings) for a in e.args]
+            new_fun = yield rco_atm(e.fun, bindings)
+            new_args = yield [rco_atm(a, bindings) for a in e.args]
             return mk_let(bindings, FuncallTE(new_fun, new_args, e.typ))
 
         elif isinstance(e, FunRefTE):
@@ -691,7 +1085,7 @@ def rco(p: RfunProgramT) -> RfunProgramT:
     prog_defns = p.defs
 
     new_defs = [rco_def(d) for d in prog_defns]
-    new_body = rco_exp(prog_body)
+    new_body = trampoline(rco_exp(prog_body))
     return RfunProgramT(new_defs, new_body)
 
 
@@ -732,7 +1126,7 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
             else:
                 return cfun.AtmExp(ec_atm(e))
 
-        def ec_assign(x: str, e: RfunExpT, k: cfun.Tail) -> cfun.Tail:
+        def ec_assign(x: str, e: RfunExpT, k: cfun.Tail) -> Iterative[cfun.Tail]:
             if isinstance(e, (IntTE, BoolTE, VoidTE, GlobalValTE)):
                 return cfun.Seq(cfun.Assign(x, ec_exp(e), False), k)
             elif isinstance(e, VarTE):
@@ -745,13 +1139,13 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
                 else:
                     return cfun.Seq(cfun.Assign(x, ec_exp(e), isinstance(e.typ, VectorT)), k)
             elif isinstance(e, LetTE):
-                return ec_assign(e.x, e.e1, ec_assign(x, e.body, k))
+                return (yield ec_assign(e.x, e.e1, (yield ec_assign(x, e.body, k))))
             elif isinstance(e, IfTE):
                 finally_label = gensym('label')
                 cfg[finally_label] = k
-                b2 = ec_assign(x, e.e2, cfun.Goto(finally_label))
-                b3 = ec_assign(x, e.e3, cfun.Goto(finally_label))
-                return ec_pred(e.e1, b2, b3)
+                b2 = yield ec_assign(x, e.e2, cfun.Goto(finally_label))
+                b3 = yield ec_assign(x, e.e3, cfun.Goto(finally_label))
+                return (yield ec_pred(e.e1, b2, b3))
 
             elif isinstance(e, FuncallTE):
                 new_fun = ec_atm(e.fun)
@@ -764,7 +1158,7 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
             else:
                 raise Exception('ec_assign', e)
 
-        def ec_pred(test: RfunExpT, b1: cfun.Tail, b2: cfun.Tail) -> cfun.Tail:
+        def ec_pred(test: RfunExpT, b1: cfun.Tail, b2: cfun.Tail) -> Iterative[cfun.Tail]:
             if isinstance(test, BoolTE):
                 if test.val:
                     return b1
@@ -783,21 +1177,28 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
                                then_label,
                                else_label)
 
-            elif isinstance(test, PrimTE):
-                if test.op == 'not':
-                    return ec_pred(test.args[0], b2, b1)
-                else:
-                    then_label = gensym('label')
-                    else_label = gensym('label')
+            elif isinstance(test, PrimTE) and test.op == 'not':
+                return (yield ec_pred(test.args[0], b2, b1))
 
-                    cfg[then_label] = b1
-                    cfg[else_label] = b2
+            elif isinstance(test, PrimTE) and test.op in ['==', '<', '<=', '>', '>=']:
+                then_label = gensym('label')
+                else_label = gensym('label')
 
-                    return cfun.If(ec_exp(test), then_label, else_label)
+                cfg[then_label] = b1
+                cfg[else_label] = b2
+
+                return cfun.If(ec_exp(test), then_label, else_label)
 
             elif isinstance(test, LetTE):
-                body_block = ec_pred(test.body, b1, b2)
-                return ec_assign(test.x, test.e1, body_block)
+                body_block = yield ec_pred(test.body, b1, b2)
+                return (yield ec_assign(test.x, test.e1, body_block))
+
+            elif isinstance(test, (PrimTE, FuncallTE)):
+                # only comparisons can be tested directly; test the result of
+                # any other operation (a call, vectorRef, ...) like a variable
+                tmp = gensym('tmp')
+                test_block = yield ec_pred(VarTE(tmp, test.typ), b1, b2)
+                return (yield ec_assign(tmp, test, test_block))
 
             elif isinstance(test, IfTE):
                 label1 = gensym('label')
@@ -805,23 +1206,23 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
                 cfg[label1] = b1
                 cfg[label2] = b2
 
-                new_b2 = ec_pred(test.e2, cfun.Goto(label1), cfun.Goto(label2))
-                new_b3 = ec_pred(test.e3, cfun.Goto(label1), cfun.Goto(label2))
+                new_b2 = yield ec_pred(test.e2, cfun.Goto(label1), cfun.Goto(label2))
+                new_b3 = yield ec_pred(test.e3, cfun.Goto(label1), cfun.Goto(label2))
 
-                return ec_pred(test.e1, new_b2, new_b3)
+                return (yield ec_pred(test.e1, new_b2, new_b3))
 
             else:
                 raise Exception('ec_pred', test)
 
-        def ec_tail(e: RfunExpT) -> cfun.Tail:
+        def ec_tail(e: RfunExpT) -> Iterative[cfun.Tail]:
             if isinstance(e, (IntTE, BoolTE, VarTE, PrimTE)):
                 return cfun.Return(ec_exp(e))
             elif isinstance(e, LetTE):
-                return ec_assign(e.x, e.e1, ec_tail(e.body))
+                return (yield ec_assign(e.x, e.e1, (yield ec_tail(e.body))))
             elif isinstance(e, IfTE):
-                b1 = ec_tail(e.e2)
-                b2 = ec_tail(e.e3)
-                return ec_pred(e.e1, b1, b2)
+                b1 = yield ec_tail(e.e2)
+                b2 = yield ec_tail(e.e3)
+                return (yield ec_pred(e.e1, b1, b2))
             elif isinstance(e, FuncallTE):
                 new_fun = ec_atm(e.fun)
                 new_args = [ec_atm(a) for a in e.args]
@@ -831,7 +1232,7 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
             else:
                 raise Exception('ec_tail', e)
 
-        cfg['start'] = ec_tail(e)
+        cfg['start'] = trampoline(ec_tail(e))
         return cfg
 
     defs = p.defs
@@ -849,6 +1250,76 @@ def explicate_control(p: RfunProgramT) -> cfun.Program:
     return output_program
 
 
+##################################################
+# remove-empty-blocks
+##################################################
+
+def remove_empty_blocks(p: cfun.Program) -> cfun.Program:
+    """
+    Removes the blocks that only jump to another block, by sending their
+    predecessors straight to the block they jump to, and the blocks that can
+    no longer be reached.
+    :param p: A Cfun program
+    :return: An equivalent Cfun program, without empty blocks
+    """
+    def remove_empty_blocks_def(d: cfun.Def) -> cfun.Def:
+        blocks = d.blocks
+
+        # Find where each empty block jumps to in the end
+        targets = {}
+        for label in blocks:
+            target = label
+            seen = set()
+            while isinstance(blocks[target], cfun.Goto) and target not in seen:
+                seen.add(target)
+                target = blocks[target].label
+            targets[label] = target
+
+        def reb_tail(tail: cfun.Tail) -> cfun.Tail:
+            # the statements of a block come first, then the jump at its end
+            stmts = []
+            while isinstance(tail, cfun.Seq):
+                stmts.append(tail.stmt)
+                tail = tail.tail
+
+            if isinstance(tail, cfun.Goto):
+                new_tail = cfun.Goto(targets[tail.label])
+            elif isinstance(tail, cfun.If):
+                new_tail = cfun.If(tail.test, targets[tail.then_label], targets[tail.else_label])
+            else:
+                new_tail = tail
+
+            for stmt in reversed(stmts):
+                new_tail = cfun.Seq(stmt, new_tail)
+            return new_tail
+
+        def successors(tail: cfun.Tail) -> List[str]:
+            while isinstance(tail, cfun.Seq):
+                tail = tail.tail
+            if isinstance(tail, cfun.Goto):
+                return [tail.label]
+            elif isinstance(tail, cfun.If):
+                return [tail.then_label, tail.else_label]
+            else:
+                return []
+
+        new_blocks = {label: reb_tail(tail) for label, tail in blocks.items()}
+
+        # Keep the blocks that can still be reached from the start
+        reachable = {'start'}
+        todo = ['start']
+        while todo:
+            for label in successors(new_blocks[todo.pop()]):
+                if label not in reachable:
+                    reachable.add(label)
+                    todo.append(label)
+
+        new_blocks = {label: tail for label, tail in new_blocks.items() if label in reachable}
+        return cfun.Def(d.name, d.args, d.output_type, new_blocks)
+
+    return cfun.Program([remove_empty_blocks_def(d) for d in p.defs])
+
+
 ##################################################
 # select-instructions
 ##################################################
@@ -1015,8 +1486,13 @@ def select_instructions(p: cfun.Program) -> Dict[str, x86.Program]:
                        [x86.Movq(mk_var(new_var, False), x86.Reg('rax')),
                         x86.Jmp(p.name + '_conclusion')]
             elif isinstance(e, cfun.Seq):
-                #raise Exception(e)
-                return si_stmt(e.stmt) + si_tail(e.tail)
+                # a sequence can be thousands of statements long, so it is
+                # walked with a loop rather than by recursion
+                instrs = []
+                while isinstance(e, cfun.Seq):
+                    instrs.extend(si_stmt(e.stmt))
+                    e = e.tail
+                return instrs + si_tail(e)
             elif isinstance(e, cfun.If):
                 assert isinstance(e.test, cfun.Prim)
                 e1, e2 = e.test.args
@@ -1122,17 +1598,19 @@ def uncover_live(program: Dict[str, x86.Program]) -> \
             elif isinstance(e, x86.Cmpq):
                 return live_after.union(vars_arg(e.e1).union(vars_arg(e.e2)))
             elif isinstance(e, (x86.Jmp, x86.JmpIf)):
-                if e.label not in label_live:
-                    ul_block(e.label)
-
                 return live_after.union(label_live[e.label])
 
             else:
                 raise Exception('ul_instr', e)
 
-        def ul_block(label: str):
+        def ul_block(label: str) -> Iterative[None]:
             instrs = blocks[label]
 
+            # the blocks this one jumps to are analyzed first
+            for i in instrs:
+                if isinstance(i, (x86.Jmp, x86.JmpIf)) and i.label not in label_live:
+                    yield ul_block(i.label)
+
             current_live_after: Set[x86.Var] = set()
 
             local_live_after_sets = []
@@ -1144,7 +1622,7 @@ def uncover_live(program: Dict[str, x86.Program]) -> \
             label_live[label] = current_live_after
 
         for block in blocks:
-            ul_block(block)
+            trampoline(ul_block(block))
 
         return program, live_after_sets
 
@@ -1266,6 +1744,18 @@ def build_interference(inputs: Tuple[Dict[str, x86.Program],
             for instr, live_after in zip(instrs, live_afters):
                 bi_instr(instr, live_after, graph)
 
+        def bi_params(instrs: List[x86.Instr], graph: InterferenceGraph):
+            # A function starts by moving its arguments out of the parameter
+            # registers, one at a time (see select_instructions). Liveness
+            # does not track registers, so make sure a variable written by
+            # one of these moves does not get the register of an argument
+            # that has not been moved yet.
+            moves = list(itertools.takewhile(
+                lambda e: isinstance(e, x86.Movq) and e.e1 in param_saved_registers, instrs))
+            for i, move in enumerate(moves):
+                for later in moves[i + 1:]:
+                    graph.add_edge(move.e2, later.e1)
+
         program, live_after_sets = inputs
         blocks = program.blocks
 
@@ -1273,6 +1763,7 @@ def build_interference(inputs: Tuple[Dict[str, x86.Program],
 
         for label in blocks.keys():
             bi_block(blocks[label], live_after_sets[label], interference_graph)
+            bi_params(blocks[label], interference_graph)
 
         return program, interference_graph
 
@@ -1316,21 +1807,21 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
     def allocate_registers_help(inputs: Tuple[x86.Program, InterferenceGraph]) -> \
             Tuple[x86.Program, int, int]:
         ## Functions for listing the variables in the program
-        def vars_arg(a: x86.Arg) -> Set[x86.Var]:
+        def vars_arg(a: x86.Arg) -> List[x86.Var]:
             if isinstance(a, (x86.Int, x86.Reg, x86.ByteReg, x86.GlobalVal, x86.Deref, x86.FunRef)):
-                return set()
+                return []
             elif isinstance(a, x86.Var):
-                return {a}
+                return [a]
             else:
                 raise Exception('vars_arg allocate_registers', a)
 
-        def vars_instr(e: x86.Instr) -> Set[x86.Var]:
+        def vars_instr(e: x86.Instr) -> List[x86.Var]:
             if isinstance(e, (x86.Movq, x86.Addq, x86.Cmpq, x86.Movzbq, x86.Xorq, x86.Leaq)):
-                return vars_arg(e.e1).union(vars_arg(e.e2))
+                return vars_arg(e.e1) + vars_arg(e.e2)
             elif isinstance(e, (x86.Set, x86.TailJmp, x86.IndirectCallq)):
                 return vars_arg(e.e1)
             elif isinstance(e, (x86.Callq, x86.Retq, x86.Jmp, x86.JmpIf, x86.Negq)):
-                return set()
+                return []
 
             else:
                 raise Exception('vars_instr allocate_registers', e)
@@ -1339,8 +1830,39 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
         register_locations = [x86.Reg(r) for r in
                               constants.caller_saved_registers + constants.callee_saved_registers]
 
+        register_colors = {r: color for color, r in enumerate(register_locations)}
+
         ## Functions for graph coloring
-        def color_graph(local_vars: Set[x86.Var], interference_graph: InterferenceGraph) -> Coloring:
+        def move_partners(blocks: Dict[str, List[x86.Instr]]) -> Dict[x86.Var, List[x86.Arg]]:
+            # Maps each variable to the variables and registers it is moved
+            # to or from, in program order
+            partners = defaultdict(list)
+            for block in blocks.values():
+                for instr in block:
+                    if isinstance(instr, x86.Movq):
+                        a, b = instr.e1, instr.e2
+                        if isinstance(a, x86.Var) and (isinstance(b, x86.Var) or b in register_colors):
+                            partners[a].append(b)
+                        if isinstance(b, x86.Var) and (isinstance(a, x86.Var) or a in register_colors):
+                            partners[b].append(a)
+            return partners
+
+        def choose_color(x: x86.Var, saturation: Saturation, coloring: Coloring,
+                         partners: Dict[x86.Var, List[x86.Arg]]) -> Color:
+            lowest = next(i for i in itertools.count() if i not in saturation)
+
+            # Prefer the color of a move partner, so that the move can be
+            # deleted, unless it would spill x when a register is free
+            for y in partners[x]:
+                color = coloring.get(y) if isinstance(y, x86.Var) else register_colors[y]
+                if color is not None and color not in saturation and \
+                        (color < len(register_locations) or lowest >= len(register_locations)):
+                    return color
+
+            return lowest
+
+        def color_graph(local_vars: List[x86.Var], interference_graph: InterferenceGraph,
+                        partners: Dict[x86.Var, List[x86.Arg]]) -> Coloring:
             coloring = {}
 
             to_color = local_vars.copy()
@@ -1356,7 +1878,7 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
                 x = max(to_color, key=lambda x: len(saturation_sets[x]))
                 to_color.remove(x)
 
-                x_color = next(i for i in itertools.count() if i not in saturation_sets[x])
+                x_color = choose_color(x, saturation_sets[x], coloring, partners)
                 coloring[x] = x_color
 
                 for y in interference_graph.neighbors(x):
@@ -1419,13 +1941,19 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
         program, interference_graph = inputs
         blocks = program.blocks
 
-        local_vars = set()
+        # the variables in the order they first appear in. This order breaks
+        # ties in color_graph and numbers the spilled locations, so the output
+        # depends neither on the order of iteration over sets (which changes
+        # from run to run) nor on the names the earlier passes chose
+        local_vars = {}
         for block in blocks.values():
             for instr in block:
-                local_vars = local_vars.union(vars_instr(instr))
+                for v in vars_instr(instr):
+                    local_vars[v] = True
+        local_vars = list(local_vars)
 
         num_registers = len(register_locations)
-        coloring = color_graph(local_vars, interference_graph)
+        coloring = color_graph(local_vars, interference_graph, move_partners(blocks))
         colors_used = set(coloring.values())
         color_map = dict(enumerate(register_locations))
         vec_color_map = dict(enumerate(register_locations))
@@ -1441,7 +1969,7 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
                     pass
                 else:
                     root_stack_spills = root_stack_spills + 1
-                    offset = root_stack_spills + 1
+                    offset = root_stack_spills
                     vec_color_map[color] = x86.Deref(-(offset * 8), 'r15')
             elif isinstance(v, x86.Var):
                 color = coloring[v]
@@ -1449,7 +1977,7 @@ def allocate_registers(inputs: Tuple[Dict[str, x86.Program],
                     pass
                 else:
                     stack_spills = stack_spills + 1
-                    offset = stack_spills + 1
+                    offset = stack_spills
                     color_map[color] = x86.Deref(-(offset * 8), 'rbp')
 
         # build "homes"
@@ -1492,7 +2020,11 @@ def patch_instructions(inputs: Dict[str, Tuple[x86.Program, int, int]]) -> \
 
     def patch_instructions_help(inputs: Tuple[x86.Program, int, int]) -> Tuple[x86.Program, int, int]:
         def pi_instr(e: x86.Instr) -> List[x86.Instr]:
-            if isinstance(e, x86.Movq) and \
+            if isinstance(e, x86.Movq) and e.e1 == e.e2:
+                # the variables were given the same home (checked first, as
+                # the home may be a stack location)
+                return []
+            elif isinstance(e, x86.Movq) and \
                     isinstance(e.e1, x86.Deref) and \
                     isinstance(e.e2, x86.Deref):
                 return [x86.Movq(e.e1, x86.Reg('rax')),
@@ -1613,12 +2145,12 @@ def print_x86(inputs: Dict[str, Tuple[x86.Program, int, int]]) -> str:
   jmp main_conclusion'''
                 else:
                     return f'''
-  addq $0, %rsp
-  subq $0, %r15
+  subq ${8 * root_stack_spills}, %r15
   popq %r14
   popq %r13
   popq %r12
   popq %rbx
+  addq ${stack_size}, %rsp
   popq %rbp
   jmp *{print_arg(e.e1)}'''
             else:
@@ -1650,17 +2182,17 @@ def print_x86(inputs: Dict[str, Tuple[x86.Program, int, int]]) -> str:
   pushq %r13
   pushq %r14
 
-
+{root_stack_inits}
   jmp {function_name}_start
 {block_instrs}
 {function_name}_conclusion:
 
-  addq ${stack_size}, %rsp
-  subq $0, %r15
+  subq ${8 * root_stack_spills}, %r15
   popq %r14
   popq %r13
   popq %r12
   popq %rbx
+  addq ${stack_size}, %rsp
   popq %rbp
   retq
 """
@@ -1689,12 +2221,12 @@ def print_x86(inputs: Dict[str, Tuple[x86.Program, int, int]]) -> str:
   callq print_int
   movq $0, %rax
 
-  addq ${stack_size}, %rsp
-  subq $0, %r15
+  subq ${8 * root_stack_spills}, %r15
   popq %r14
   popq %r13
   popq %r12
   popq %rbx
+  addq ${stack_size}, %rsp
   popq %rbp
   retq
 """
@@ -1716,13 +2248,17 @@ def print_x86(inputs: Dict[str, Tuple[x86.Program, int, int]]) -> str:
 
 compiler_passes = {
     'typecheck': typecheck,
-    'shrink': shrink,
+    'inline functions': inline_functions,
     'uniquify': uniquify,
+    'shrink': shrink,
+    'fold constants': fold_constants,
+    'remove dead lets': remove_dead_lets,
     'reveal functions': reveal_functions,
     'limit functions': limit_functions,
     'expose allocation': expose_alloc,
     'remove complex opera*': rco,
     'explicate control': explicate_control,
+    'remove empty blocks': remove_empty_blocks,
     'select instructions': select_instructions,
     'uncover live': uncover_live,
     'build interference': build_interference,
@@ -1731,14 +2267,360 @@ compiler_passes = {
     'print x86': print_x86
 }
 
+# Passes written as Rewriters, each with a function that makes the pass's
+# rewriter for a program. Consecutive ones are fused into a single traversal
+# of the program (see fuse_passes), except when logging, which prints the
+# output of each pass. A pass belongs here only if fusing it gives the same
+# program as running it alone (see Rewriter); remove_dead_lets counts the
+# reads of each variable, so it runs alone.
+rewrite_passes = {
+    'uniquify': Uniquify,
+    'shrink': lambda p: Shrink(),
+    'fold constants': lambda p: FoldConstants(),
+    'reveal functions': RevealFunctions,
+    'limit functions': lambda p: LimitFunctions(),
+    'expose allocation': lambda p: ExposeAlloc()
+}
+
+def fuse_passes(passes: List[Tuple[str, Callable]]) -> List[Tuple[str, Callable]]:
+    """
+    Replaces each run of consecutive passes in rewrite_passes with one pass
+    that runs all of their rewriters in one traversal.
+    :param passes: A list of (name, pass function) pairs
+    :return: The passes, with fused passes named after the passes they run
+    """
+    def fused_pass(names: List[str]) -> Callable:
+        return lambda p: rewrite_program(p, [rewrite_passes[name](p) for name in names])
+
+    result = []
+    group = []
+    for pass_name, pass_fn in passes + [(None, None)]:
+        if pass_name in rewrite_passes:
+            group.append(pass_name)
+            continue
+
+        if len(group) == 1:
+            result.append((group[0], compiler_passes[group[0]]))
+        elif len(group) > 1:
+            result.append((' + '.join(group), fused_pass(group)))
+        group = []
 
-def run_compiler(s: str, logging=False) -> str:
+        if pass_name is not None:
+            result.append((pass_name, pass_fn))
+
+    return result
+
+# The passes after explicate_control handle each function independently
+backend_passes = ['select instructions', 'uncover live', 'build interference',
+                  'allocate registers', 'patch instructions', 'print x86']
+
+def run_backend(p: cfun.Program, gensym_num: int) -> str:
+    """
+    Runs the backend passes on a program, in a compilation of its own.
+    :param p: The output of explicate_control (or a part of it)
+    :param gensym_num: The gensym counter to start from, so that new names do
+    not clash with the names already in p
+    :return: The x86 code of the functions in p, as a string
+    """
+    with new_compilation():
+        compilation().gensym_num = gensym_num
+        current_program = p
+        for pass_name in backend_passes:
+            current_program = compiler_passes[pass_name](current_program)
+
+    return current_program
+
+def run_backend_parallel(p: cfun.Program, max_workers=None) -> str:
+    """
+    Runs the backend passes on each function of a program in a pool of
+    processes, and joins the code of the functions in their original order.
+    :param p: The output of explicate_control
+    :param max_workers: The number of processes; None uses one per CPU
+    :return: The x86 program, as a string
+    """
+    # only needed here, so loaded only when compiling in parallel
+    from concurrent.futures import ProcessPoolExecutor
+
+    # every function starts from the same counter, so the result does not
+    # depend on how the functions are spread over the processes
+    gensym_num = compilation().gensym_num
+    parts = [cfun.Program([d]) for d in p.defs]
+
+    # send small functions in batches, a few per process
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(parts) // (4 * workers))
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        codes = executor.map(run_backend, parts, itertools.repeat(gensym_num, len(parts)),
+                             chunksize=chunksize)
+        return ''.join(codes)
+
+
+##################################################
+# Incremental compilation
+##################################################
+
+def def_signature(defn: RfunDef) -> FunT:
+    return FunT([t for _, t in defn.args], defn.output_type)
+
+def referenced_functions(e: RfunExp, functions: Set[str]) -> Set[str]:
+    """
+    Finds the top-level functions an expression refers to.
+    :param e: An Rfun expression
+    :param functions: The names of the program's top-level functions
+    :return: The names in functions that appear as variables in e
+    """
+    found = set()
+    to_visit = [e]
+    while to_visit:
+        e = to_visit.pop()
+        if isinstance(e, Var):
+            if e.var in functions:
+                found.add(e.var)
+        elif isinstance(e, (Int, Bool)):
+            pass
+        elif isinstance(e, Let):
+            to_visit.extend([e.e1, e.body])
+        elif isinstance(e, Prim):
+            to_visit.extend(e.args)
+        elif isinstance(e, If):
+            to_visit.extend([e.e1, e.e2, e.e3])
+        elif isinstance(e, Funcall):
+            to_visit.append(e.fun)
+            to_visit.extend(e.args)
+        else:
+            raise Exception('referenced_functions', e)
+
+    return found
+
+def ast_repr(obj) -> Iterative[str]:
+    """
+    Like repr, for ASTs too deep for repr to handle.
+    """
+    if isinstance(obj, (AST, RType)):
+        flds = yield [ast_repr(getattr(obj, f.name)) for f in fields(obj)]
+        return f'{type(obj).__name__}({", ".join(flds)})'
+    elif isinstance(obj, list):
+        items = yield [ast_repr(a) for a in obj]
+        return f'[{", ".join(items)}]'
+    elif isinstance(obj, tuple):
+        items = yield [ast_repr(a) for a in obj]
+        return f'({", ".join(items)})'
+    else:
+        return repr(obj)
+
+# The modules whose source determines the code the compiler generates: the
+# compiler itself, and the definitions of the ASTs it reads and builds
+compiler_modules = [__name__, 'rfun_parser', 'typed_rfun', 'cfun',
+                    'cs202_support.base_ast', 'cs202_support.x86exp']
+
+compiler_source_hash = None
+
+def compiler_version() -> str:
+    """
+    Fingerprints the compiler: a hash of the source of compiler_modules, of
+    the values in constants.py and of the inlining limits, so that code
+    cached by one version of the compiler, or with other settings, is not
+    reused by another.
+    """
+    global compiler_source_hash
+    if compiler_source_hash is None:
+        h = hashlib.sha256()
+        for name in compiler_modules:
+            with open(sys.modules[name].__file__, 'rb') as f:
+                h.update(f'{name} '.encode())
+                h.update(hashlib.sha256(f.read()).digest())
+        compiler_source_hash = h.hexdigest()
+
+    values = sorted((name, v) for name, v in vars(constants).items()
+                    if not name.startswith('_'))
+    limits = (inline_max_size, inline_fuel)
+    return hashlib.sha256(f'{compiler_source_hash} {values!r} {limits!r}'.encode()).hexdigest()
+
+def program_key(s: str, incremental: bool) -> str:
+    """
+    Computes the cache key of a whole program: a hash of its source text, of
+    the compiler version, and of how the program was compiled (the
+    incremental compiler does not inline across definitions, so its code
+    differs).
+    """
+    h = hashlib.sha256(compiler_version().encode())
+    h.update(b'incremental program ' if incremental else b'program ')
+    h.update(s.encode())
+    return h.hexdigest()
+
+def fingerprint(unit: Union[RfunDef, RfunExp], signatures: Dict[str, FunT], version: str) -> str:
+    """
+    Computes the cache key of a definition (or of the program's body): a hash of
+    its code, its signature and the signatures of the functions it refers to.
+    :param unit: A definition, or the body of the program
+    :param signatures: The signatures of all top-level functions
+    :param version: The compiler version, from compiler_version
+    :return: A hex string
+    """
+    body = unit.body if isinstance(unit, RfunDef) else unit
+    h = hashlib.sha256(version.encode())
+    h.update(trampoline(ast_repr(unit)).encode())
+    for name in sorted(referenced_functions(body, set(signatures))):
+        h.update(f'{name}: {signatures[name]!r}'.encode())
+    return h.hexdigest()
+
+def compile_unit(p: RfunProgram, name: str, signatures: Dict[str, FunT]) -> str:
+    """
+    Compiles one function of a program by itself.
+    :param p: A program holding the function's definition (or, for main, the
+    program's body)
+    :param name: The name of the function
+    :param signatures: The signatures of all top-level functions
+    :return: The function's x86 code, as print_x86 prints it
+    """
+    # generated names (labels in particular) carry the function's name, so
+    # the code of a function does not depend on the rest of the program, and
+    # never clashes with the code of other functions
+    with new_compilation(f'{name}_', signatures):
+        current_program = p
+        for pass_name, pass_fn in fuse_passes(list(compiler_passes.items())):
+            if pass_name == 'print x86':
+                current_program = {name: current_program[name]}
+            current_program = pass_fn(current_program)
+
+    return current_program
+
+# The cache directory holds one file of x86 code per key (whole programs and
+# single functions alike). Reading an entry marks it as recently used, and
+# evict_cache removes the least recently used entries once the files take up
+# more than cache_max_bytes. Several compilers may share a directory: entries
+# are written to a temporary file and renamed into place, so readers only ever
+# see complete files.
+cache_max_bytes = 2**26
+
+def cache_read(cache_dir: str, key: str) -> Union[str, None]:
+    """
+    Reads the code cached under key.
+    :return: The code, or None if it is not in the cache
+    """
+    cache_file = os.path.join(cache_dir, key + '.s')
+    try:
+        with open(cache_file) as f:
+            code = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        os.utime(cache_file)
+    except FileNotFoundError:
+        # evicted by another compiler in the meantime
+        pass
+    return code
+
+def cache_write(cache_dir: str, key: str, code: str):
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(code)
+        os.replace(temp_file, os.path.join(cache_dir, key + '.s'))
+    except:
+        os.remove(temp_file)
+        raise
+
+def evict_cache(cache_dir: str, max_bytes: int = cache_max_bytes):
+    """
+    Removes the least recently used entries from the cache until the rest take
+    up at most max_bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.s'):
+            try:
+                info = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, entry.path, info.st_size))
+
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total = total - size
+
+def run_compiler_incremental(s: str, cache_dir: str, logging=False) -> str:
+    """
+    Run the compiler on an input program, reusing the code of each definition
+    that has not changed since an earlier run. The code of each function is
+    cached in cache_dir, under its fingerprint; only definitions with no cached
+    code are compiled.
+    :param s: An Rfun program, as a string.
+    :param cache_dir: The directory for cached code (see cache_read).
+    :param logging: Whether or not to print which functions were compiled.
+    :return: An x86 program, as a string
+    """
+    p = parse_rfun(s)
+    version = compiler_version()
+    signatures = {d.name: def_signature(d) for d in p.defs}
+
+    # each definition is compiled with a trivial body, which is thrown away
+    units = [(d.name, RfunProgram([d], Int(0)), fingerprint(d, signatures, version))
+             for d in p.defs]
+    units.append(('main', RfunProgram([], p.body), fingerprint(p.body, signatures, version)))
+
+    final_string = ''
+    for name, unit, key in units:
+        code = cache_read(cache_dir, key)
+        if code is not None:
+            if logging == True:
+                print(f'Reused cached code for {name}')
+        else:
+            code = compile_unit(unit, name, signatures)
+            cache_write(cache_dir, key, code)
+            if logging == True:
+                print(f'Compiled {name}')
+
+        final_string += code
+
+    return final_string
+
+
+def run_compiler(s: str, logging=False, cache_dir=None, max_workers=1, incremental=False,
+                 fused=True) -> str:
     """
     Run the compiler on an input program.
     :param s: An Rfun program, as a string.
     :param logging: Whether or not to print out debugging information.
+    :param cache_dir: If given, cache compiled code in this directory. A
+    program compiled before (with the same compiler and constants) is read
+    back without parsing or running any pass; otherwise it is compiled as
+    usual, and its code is cached.
+    :param max_workers: The number of processes for the backend passes, which
+    handle each function separately. 1 runs them all in this process; None
+    uses one process per CPU.
+    :param incremental: With cache_dir, compile a program that is not in the
+    cache with run_compiler_incremental, which also reuses the code of
+    unchanged functions. Functions are then compiled one at a time, so calls
+    are not inlined across definitions.
+    :param fused: Whether to fuse the passes in rewrite_passes into single
+    traversals (see fuse_passes). Both ways give the same code; logging never
+    fuses them, so that it can print the output of each pass.
     :return: An x86 program, as a string
     """
+    if cache_dir is not None:
+        key = program_key(s, incremental)
+        code = cache_read(cache_dir, key)
+        if code is None:
+            if incremental:
+                code = run_compiler_incremental(s, cache_dir, logging)
+            else:
+                code = run_compiler(s, logging, max_workers=max_workers, fused=fused)
+            cache_write(cache_dir, key, code)
+            evict_cache(cache_dir)
+        elif logging == True:
+            print('Reused cached code for the program')
+        return code
+
     current_program = parse_rfun(s)
 
     if logging == True:
@@ -1749,16 +2631,26 @@ def run_compiler(s: str, logging=False) -> str:
         print()
         print(print_ast(current_program))
 
-    for pass_name, pass_fn in compiler_passes.items():
-        current_program = pass_fn(current_program)
-
-        if logging == True:
-            print()
-            print('==================================================')
-            print(f' Output of pass: {pass_name}')
-            print('==================================================')
-            print()
-            print(print_ast(current_program))
+    passes = list(compiler_passes.items())
+    if logging != True and fused:
+        passes = fuse_passes(passes)
+    if max_workers != 1:
+        # the backend passes run as one step, per function, in a process pool
+        frontend = passes[:passes.index(('select instructions', select_instructions))]
+        passes = frontend + [('backend (in parallel)',
+                              lambda p: run_backend_parallel(p, max_workers))]
+
+    with new_compilation():
+        for pass_name, pass_fn in passes:
+            current_program = pass_fn(current_program)
+
+            if logging == True:
+                print()
+                print('==================================================')
+                print(f' Output of pass: {pass_name}')
+                print('==================================================')
+                print()
+                print(print_ast(current_program))
 
     assert isinstance(current_program, str)
     return current_program
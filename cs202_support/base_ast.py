@@ -1,10 +1,13 @@
 from dataclasses import dataclass, fields
+from typing import Any, Generator, TypeVar
 
+# Nodes and types are numerous, so they keep their fields in slots rather
+# than a per-instance __dict__ (see the @dataclass(slots=True) classes)
 class AST:
-    pass
+    __slots__ = ()
 
 class RType:
-    pass
+    __slots__ = ()
 
 def print_type(obj, depth=0):
     if depth > 5:
@@ -22,7 +25,69 @@ def print_type(obj, depth=0):
     else:
         return str(obj)
 
+T = TypeVar('T')
+
+# A recursive function over a deeply nested AST (such as a chain of thousands
+# of lets) can run out of Python's stack. Such functions are written as
+# generators instead: each recursive call is yielded, and its result is sent
+# back into the generator. Yielding a list of calls runs them in order and
+# sends back the list of their results:
+#
+#   def size(e) -> Iterative[int]:
+#       if isinstance(e, Let):
+#           n1, n2 = yield [size(e.e1), size(e.body)]
+#           return n1 + n2 + 1
+#       ...
+#
+# trampoline(size(e)) runs the calls with a stack of its own, so the depth of
+# the AST is limited only by memory.
+Iterative = Generator[Any, Any, T]
+
+def _sequence(calls):
+    results = []
+    for call in calls:
+        results.append((yield call))
+    return results
+
+def trampoline(gen: Iterative[T]) -> T:
+    """
+    Runs a function written as a generator (see Iterative) to completion.
+    :param gen: The generator returned by calling the function
+    :return: The function's result
+    """
+    stack = []      # the callers of gen
+    value = None
+    error = None
+
+    while True:
+        try:
+            if error is None:
+                call = gen.send(value)
+            else:
+                # pass an exception on to the caller, as a recursive call would
+                e, error = error, None
+                call = gen.throw(e)
+        except StopIteration as result:
+            if not stack:
+                return result.value
+            gen = stack.pop()
+            value = result.value
+        except BaseException as e:
+            if not stack:
+                raise
+            gen = stack.pop()
+            error = e
+        else:
+            if type(call) is list:
+                call = _sequence(call)
+            stack.append(gen)
+            gen = call
+            value = None
+
 def print_ast(obj, indent=0):
+    return trampoline(print_ast_help(obj, indent))
+
+def print_ast_help(obj, indent=0) -> Iterative[str]:
     if isinstance(obj, AST):
         name = type(obj).__name__
         flds = [getattr(obj, f.name) for f in fields(obj)]
@@ -31,10 +96,10 @@ def print_ast(obj, indent=0):
         if len(flds) == 0:
             return indentation + f'{name}()'
         elif len(flds) == 1 and isinstance(flds[0], (str, int)):
-            children = ''.join([print_ast(f_v, indent=0) for f_v in flds])
+            children = ''.join((yield [print_ast_help(f_v, indent=0) for f_v in flds]))
             return indentation + f'{name}({children})'
         else:
-            children = ',\n'.join([print_ast(f_v, indent=indent+1) for f_v in flds])
+            children = ',\n'.join((yield [print_ast_help(f_v, indent=indent+1) for f_v in flds]))
             return indentation + f'{name}(\n{children})'
 
     elif isinstance(obj, RType):
@@ -45,25 +110,25 @@ def print_ast(obj, indent=0):
         if len(obj) == 0:
             return ' ' * indent + '[]'
         else:
-            children = ',\n'.join([print_ast(e, indent=indent+1) for e in obj])
+            children = ',\n'.join((yield [print_ast_help(e, indent=indent+1) for e in obj]))
             return ' ' * indent + '[\n' + children + '\n' + ' ' * indent + ']'
 
     elif isinstance(obj, set):
         if len(obj) == 0:
             return ' ' * indent + '{}'
         else:
-            children = ',\n'.join([print_ast(e, indent=indent+1) for e in obj])
+            children = ',\n'.join((yield [print_ast_help(e, indent=indent+1) for e in obj]))
             return ' ' * indent + '{\n' + children + '\n' + ' ' * indent + '}'
 
     elif isinstance(obj, tuple):
         first, *rest = obj
-        first_str = print_ast(first, indent=0) + ',\n'
-        rest_str = ',\n'.join([print_ast(e, indent=indent+1) for e in rest])
+        first_str = (yield print_ast_help(first, indent=0)) + ',\n'
+        rest_str = ',\n'.join((yield [print_ast_help(e, indent=indent+1) for e in rest]))
         return ' ' * indent + '(' + first_str + rest_str + ')'
 
     elif isinstance(obj, dict):
         keys = [' ' * (indent+1) + "'" + k + "':" for k in obj.keys()]
-        val_strs = [print_ast(v, indent=indent+2) for v in obj.values()]
+        val_strs = yield [print_ast_help(v, indent=indent+2) for v in obj.values()]
         all_strs = [k + '\n' + v for k, v in zip(keys, val_strs)]
 
         final_result = ' ' * indent + '{\n' + '\n'.join(all_strs) + '\n' + ' ' * indent + '}'
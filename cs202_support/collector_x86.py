@@ -0,0 +1,112 @@
+from typing import Dict, List
+
+from .memory_x86 import Memory
+
+# A copying (Cheney) garbage collector for the emulator's heap.
+#
+# Vectors are laid out as a tag word followed by one word per element. Tags
+# are built by mk_tag in compiler.py:
+#
+#   bit 0       1 if the object has not been forwarded
+#   bits 1-6    the number of elements
+#   bits 7-     the pointer mask. The first element's bit is the highest bit
+#               of the mask and the last element's bit is bit 7.
+#
+# A forwarded object's tag word holds the address of its copy instead. Copies
+# are 8-byte aligned, so bit 0 of a forwarding address is always 0.
+
+def tag_length(tag: int) -> int:
+    return (tag >> 1) & 0b111111
+
+def tag_pointer_mask(tag: int) -> int:
+    return tag >> 7
+
+def is_pointer_field(tag: int, i: int) -> bool:
+    """
+    Returns True if element i of the object with this tag is a vector.
+    """
+    return (tag_pointer_mask(tag) >> (tag_length(tag) - 1 - i)) & 1 == 1
+
+def copy_collect(memory: Memory, rootstack_begin: int, rootstack_ptr: int,
+                 fromspace_begin: int, fromspace_end: int, free_ptr: int,
+                 needed: int, heap_floor: int) -> Dict[str, int]:
+    """
+    Copies the live objects in the "heap" segment of memory into a new
+    segment, which then replaces it as the heap. The root set is the root
+    stack, from rootstack_begin up to rootstack_ptr.
+    :param needed: The number of bytes the program wants to allocate; the new
+    heap is grown until it has at least this much free space
+    :param heap_floor: The lowest address the heap may be placed at
+    :return: A dict with the new heap bounds (fromspace_begin, fromspace_end,
+    free_ptr) and statistics about the collection
+    """
+    size = fromspace_end - fromspace_begin
+
+    # alternate between the space below the current heap (when there is room)
+    # and the space right after it
+    if heap_floor + size <= fromspace_begin:
+        tospace_begin = heap_floor
+    else:
+        tospace_begin = fromspace_end
+    tospace = memory.add_segment('tospace', tospace_begin, tospace_begin + size)
+
+    stats = {'bytes_copied': 0, 'objects_copied': 0, 'roots': 0, 'words_scanned': 0}
+    to_free = tospace_begin
+
+    def in_fromspace(v) -> bool:
+        return type(v) is int and fromspace_begin <= v < free_ptr
+
+    def forward(addr: int) -> int:
+        nonlocal to_free
+
+        tag = memory.load(addr)
+        if tag & 1 == 0:
+            # already copied; the tag word holds the new address
+            return tag
+
+        num_words = tag_length(tag) + 1
+        new_addr = to_free
+        for i in range(num_words):
+            memory.store(new_addr + 8 * i, memory.peek(addr + 8 * i))
+        to_free = to_free + 8 * num_words
+
+        memory.store(addr, new_addr)
+        stats['bytes_copied'] = stats['bytes_copied'] + 8 * num_words
+        stats['objects_copied'] = stats['objects_copied'] + 1
+        return new_addr
+
+    # copy the objects the roots point to
+    for root in range(rootstack_begin, rootstack_ptr, 8):
+        v = memory.peek(root)
+        stats['words_scanned'] = stats['words_scanned'] + 1
+        if in_fromspace(v):
+            stats['roots'] = stats['roots'] + 1
+            memory.store(root, forward(v))
+
+    # then scan the copies, copying the objects they point to
+    scan = tospace_begin
+    while scan < to_free:
+        tag = memory.load(scan)
+        length = tag_length(tag)
+        for i in range(length):
+            field = scan + 8 * (i + 1)
+            stats['words_scanned'] = stats['words_scanned'] + 1
+            if is_pointer_field(tag, i):
+                v = memory.load(field)
+                if in_fromspace(v):
+                    memory.store(field, forward(v))
+        scan = scan + 8 * (length + 1)
+
+    memory.remove_segment('heap')
+    tospace.name = 'heap'
+
+    # grow the new heap if the live data leaves too little room
+    new_size = max(size, 8)
+    while tospace_begin + new_size - to_free < needed:
+        new_size = new_size * 2
+    tospace.end = tospace_begin + new_size
+
+    stats['fromspace_begin'] = tospace_begin
+    stats['fromspace_end'] = tospace_begin + new_size
+    stats['free_ptr'] = to_free
+    return stats
@@ -0,0 +1,225 @@
+from typing import Dict, List, Tuple, Any
+
+# Decoded form of the x86 programs run by the emulator.
+#
+# An instruction is a tuple (op, a1, a2), where op is one of the integer
+# opcodes below. a1 and a2 are operand descriptors, labels, or condition
+# masks depending on the opcode:
+#
+#   (MOVQ, src, dst)      (CALLQ, label, None)     (JCC, mask, label)
+#   (SETCC, mask, dst)    (JMP, label, None)       (RETQ, None, None)
+#
+# After linearize, jump and call targets are positions in the instruction
+# list rather than labels.
+#
+# An operand descriptor is a tuple whose first element is its kind:
+#
+#   (ARG_REG, reg_index)            %reg
+#   (ARG_IMM, value)                $int
+#   (ARG_VAR, name)                 #name
+#   (ARG_MEM, reg_index, offset)    offset(%reg) and (%reg)
+#   (ARG_GLOBAL, name)              name(%rip)
+
+Operand = Tuple[Any, ...]
+DecodedInstr = Tuple[int, Any, Any]
+
+##################################################
+# Registers and flags
+##################################################
+
+REGISTERS = ['rsp', 'rbp', 'rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15',
+             'al', 'rip', 'EFLAGS']
+REGISTER_INDEX = {name: i for i, name in enumerate(REGISTERS)}
+
+RSP = REGISTER_INDEX['rsp']
+RBP = REGISTER_INDEX['rbp']
+RAX = REGISTER_INDEX['rax']
+RSI = REGISTER_INDEX['rsi']
+RDI = REGISTER_INDEX['rdi']
+R15 = REGISTER_INDEX['r15']
+EFLAGS = REGISTER_INDEX['EFLAGS']
+
+# The result of cmpq is stored in EFLAGS as one of these bits, and each
+# condition code is the mask of the results it accepts.
+FLAG_E = 1
+FLAG_L = 2
+FLAG_G = 4
+
+FLAG_NAMES = {FLAG_E: 'e', FLAG_L: 'l', FLAG_G: 'g'}
+
+CONDITION_MASKS = {
+    'e': FLAG_E,
+    'l': FLAG_L,
+    'le': FLAG_L | FLAG_E,
+    'g': FLAG_G,
+    'ge': FLAG_G | FLAG_E,
+}
+
+##################################################
+# Opcodes and operand kinds
+##################################################
+
+MOVQ = 0
+ADDQ = 1
+SUBQ = 2
+CMPQ = 3
+JCC = 4
+JMP = 5
+SETCC = 6
+MOVZBQ = 7
+XORQ = 8
+NEGQ = 9
+LEAQ = 10
+PUSHQ = 11
+POPQ = 12
+CALLQ = 13
+INDIRECT_CALLQ = 14
+INDIRECT_JMP = 15
+RETQ = 16
+# produced by linearize for calls to labels outside the program, such as the
+# runtime functions print_int, initialize and collect
+CALL_RUNTIME = 17
+
+OPCODE_NAMES = ['movq', 'addq', 'subq', 'cmpq', 'jcc', 'jmp', 'setcc',
+                'movzbq', 'xorq', 'negq', 'leaq', 'pushq', 'popq', 'callq',
+                'indirect_callq', 'indirect_jmp', 'retq', 'call_runtime']
+
+ARG_REG = 0
+ARG_IMM = 1
+ARG_VAR = 2
+ARG_MEM = 3
+ARG_GLOBAL = 4
+
+_binary_ops = {
+    'movq': MOVQ,
+    'addq': ADDQ,
+    'subq': SUBQ,
+    'cmpq': CMPQ,
+    'movzbq': MOVZBQ,
+    'xorq': XORQ,
+    'leaq': LEAQ,
+}
+
+_unary_ops = {
+    'negq': NEGQ,
+    'pushq': PUSHQ,
+    'popq': POPQ,
+    'indirect_callq': INDIRECT_CALLQ,
+    'indirect_jmp': INDIRECT_JMP,
+}
+
+##################################################
+# Decoding Lark parse trees
+##################################################
+
+def decode_imm(e) -> int:
+    if e.data == 'int_a':
+        return int(e.children[0])
+    elif e.data == 'neg_a':
+        return -decode_imm(e.children[0])
+    else:
+        raise Exception('decode_imm: unknown immediate:', e)
+
+def decode_arg(a) -> Operand:
+    if a.data == 'reg_a':
+        return (ARG_REG, REGISTER_INDEX[str(a.children[0])])
+    elif a.data == 'var_a':
+        return (ARG_VAR, str(a.children[0]))
+    elif a.data == 'int_a':
+        return (ARG_IMM, decode_imm(a.children[0]))
+    elif a.data == 'mem_a':
+        offset, reg = a.children
+        return (ARG_MEM, REGISTER_INDEX[str(reg)], decode_imm(offset))
+    elif a.data == 'direct_mem_a':
+        reg = a.children[0]
+        return (ARG_MEM, REGISTER_INDEX[str(reg)], 0)
+    elif a.data == 'global_val_a':
+        loc, reg = a.children
+        assert str(reg) == 'rip', a
+        return (ARG_GLOBAL, str(loc))
+    else:
+        raise RuntimeError(f'Unknown arg in decode_arg: {a}')
+
+def decode_instr(instr) -> DecodedInstr:
+    name = instr.data
+
+    if name in _binary_ops:
+        a1, a2 = instr.children
+        return (_binary_ops[name], decode_arg(a1), decode_arg(a2))
+    elif name in _unary_ops:
+        return (_unary_ops[name], decode_arg(instr.children[0]), None)
+    elif name == 'jmp':
+        return (JMP, str(instr.children[0]), None)
+    elif name in ['je', 'jl', 'jle', 'jg', 'jge']:
+        return (JCC, CONDITION_MASKS[name[1:]], str(instr.children[0]))
+    elif name in ['sete', 'setl', 'setle', 'setg', 'setge']:
+        return (SETCC, CONDITION_MASKS[name[3:]], decode_arg(instr.children[0]))
+    elif name == 'callq':
+        return (CALLQ, str(instr.children[0]), None)
+    elif name == 'retq':
+        return (RETQ, None, None)
+    else:
+        raise RuntimeError(f'Unknown instruction: {name}')
+
+def decode_instrs(instrs) -> List[DecodedInstr]:
+    return [decode_instr(i) for i in instrs]
+
+def decode_program(p) -> Dict[str, List[DecodedInstr]]:
+    """
+    Decodes a parsed x86 program into a dict mapping each block label to its
+    list of decoded instructions.
+    :param p: A Lark tree produced by x86_parser
+    :return: A dict of decoded blocks, in program order
+    """
+    assert p.data == 'prog'
+    blocks = {}
+
+    for b in p.children:
+        assert b.data == 'block'
+        block_name, *instrs = b.children
+        blocks[str(block_name)] = decode_instrs(instrs)
+
+    return blocks
+
+##################################################
+# Linearizing decoded blocks
+##################################################
+
+def linearize(blocks: Dict[str, List[DecodedInstr]]) -> Tuple[List[DecodedInstr], Dict[str, int]]:
+    """
+    Lays out decoded blocks one after another in a single instruction list,
+    in program order, and resolves jump and call targets to positions in it.
+    :param blocks: A dict mapping block labels to decoded instructions
+    :return: A Tuple. The first element is the list of instructions. The
+    second is a dict mapping each label to the position of its first
+    instruction.
+    """
+    labels = {}
+    pc = 0
+    for label, instrs in blocks.items():
+        labels[label] = pc
+        pc = pc + len(instrs)
+
+    def target(label: str) -> int:
+        if label in labels:
+            return labels[label]
+        else:
+            raise RuntimeError(f'Unknown label: {label}')
+
+    code = []
+    for instrs in blocks.values():
+        for instr in instrs:
+            op, a1, a2 = instr
+            if op == JMP:
+                code.append((JMP, target(a1), None))
+            elif op == JCC:
+                code.append((JCC, a1, target(a2)))
+            elif op == CALLQ and a1 in labels:
+                code.append((CALLQ, labels[a1], None))
+            elif op == CALLQ:
+                code.append((CALL_RUNTIME, a1, None))
+            else:
+                code.append(instr)
+
+    return code, labels
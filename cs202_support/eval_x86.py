@@ -1,49 +1,114 @@
 from collections import defaultdict
+import bisect
+import os
+import sys
+import time
 from dataclasses import dataclass
+from typing import List, Optional
 
-from .parser_x86 import x86_parser, x86_parser_instrs
-
-import pandas as pd
+from .reader_x86 import read_program, read_instrs
+from .decode_x86 import *
+from .memory_x86 import Memory, MemoryAccessError, UNINITIALIZED, INTEGER, WORD_MIN, WORD_MAX, wrap
+from .table import Table
+from .collector_x86 import copy_collect
+from .profile_x86 import Profile
+from .translate_x86 import compile_program, compare_failed
 
 @dataclass
 class FunPointer:
     fun_name: str
 
+class ExecutionLimitExceeded(RuntimeError):
+    """
+    Raised when a run uses up its instruction budget or its time limit. The
+    emulator stays in the state the run stopped in, so after raising the
+    limit the run can be continued with resume.
+    """
+    def __init__(self, message, instructions_executed, run_time, pc, label, output):
+        super().__init__(message)
+        self.instructions_executed = instructions_executed
+        self.run_time = run_time
+        self.pc = pc
+        self.label = label
+        self.output = output
+
+class InstructionLimitExceeded(ExecutionLimitExceeded):
+    pass
+
+class TimeLimitExceeded(ExecutionLimitExceeded):
+    pass
+
+# Memory layout: the stack grows down from STACK_TOP, and initialize places
+# the root stack and the heap at fixed addresses above it
+STACK_TOP = 1000
+ROOTSTACK_BEGIN = 2000
+FROMSPACE_BEGIN = 100000
+
+# With a time limit, the clock is checked after this many instructions
+TIME_CHECK_INTERVAL = 10000
+
 class X86Emulator:
-    def __init__(self, logging=True):
-        self.registers = defaultdict(lambda: None)
-        self.memory = defaultdict(lambda: None)
+    def __init__(self, logging=True, max_instructions=None, stack_size=2**23,
+                 profile=False, compiled=False, time_limit=None):
+        self.registers = [None] * len(REGISTERS)
+        self.memory = Memory(STACK_TOP, stack_size)
         self.variables = defaultdict(lambda: None)
         self.logging = logging
-        self.registers['rbp'] = 1000
-        self.registers['rsp'] = 1000
+        self.registers[RBP] = STACK_TOP
+        self.registers[RSP] = STACK_TOP
 
         self.global_vals = {}
+
+        # the program being run, laid out by linearize, and the return
+        # addresses of the calls in progress
+        self.code = []
+        self.labels = {}
+        self.return_stack = []
+
+        # the position of the next instruction of the loaded program, None
+        # once it has finished, and the output it has printed so far
+        self.pc = None
+        self.output = []
+
+        # None means no limit on the number of instructions executed, or on
+        # the seconds spent running the program
+        self.max_instructions = max_instructions
+        self.instructions_executed = 0
+        self.time_limit = time_limit
+        self.run_time = 0.0
+
+        # the number of instructions executed at which the current call to
+        # resume suspends the run, when that call started, and the time at
+        # which it runs out of time
+        self.stop_at = None
+        self.resumed_at = None
+        self.deadline = None
+
+        # one dict of statistics per call to collect
+        self.gc_stats = []
+
+        # run programs by translating their blocks to Python functions
+        # (see translate_x86.py), rather than one instruction at a time
+        self.compiled = compiled
+
+        # execution counters, collected only when profiling
+        if profile:
+            self.profile = Profile()
+            self.memory.counts = self.profile.memory_counts
+        else:
+            self.profile = None
     
     def log(self, s):
         if self.logging:
             print(s)
     
     def eval_program(self, s):
-        p = x86_parser.parse(s)
-        
-        assert p.data == 'prog'
-        blocks = {}
-        output = []
-
-        # transform the program into a dict of blocks
-        for b in p.children:
-            assert b.data == 'block'
-            block_name, *instrs = b.children
-            name = str(block_name)
-            blocks[name] = instrs
-            self.global_vals[name] = FunPointer(name)
+        self.load_program(s)
+        output = self.output
 
         self.log('============================== STARTING EXECUTION ==============================')
     
-        # start evaluating at "main"
-        self.eval_instrs(blocks['main'], blocks,
-                         output)
+        self.resume()
 
         self.log('FINAL STATE:')
         if self.logging:
@@ -55,14 +120,12 @@ class X86Emulator:
         return output
 
     def eval_instructions(self, s):
-        p = x86_parser_instrs.parse(s)
+        self.code, self.labels = linearize({'instrs': read_instrs(s)})
+        self.pc = 0
+        self.output = output = []
 
-        assert p.data == 'instrs'
-        blocks = {}
-        output = []
-
-        orig_memory = self.memory.copy()
-        orig_registers = self.registers.copy()
+        orig_memory = defaultdict(lambda: None, self.memory.snapshot())
+        orig_registers = dict(self.register_items())
         orig_variables = self.variables.copy()
 
         
@@ -72,8 +135,7 @@ class X86Emulator:
 
         self.log('============================== STARTING EXECUTION ==============================')
     
-        # start evaluating at "main"
-        self.eval_instrs(p.children, blocks, output)
+        self.resume()
 
         self.log('FINAL STATE:')
         if self.logging:
@@ -82,18 +144,106 @@ class X86Emulator:
         self.log(f'OUTPUT: {output}')
         self.log('============================== FINISHED EXECUTION ==============================')
 
-        changes_memory = [[ f'mem {k}', orig_memory[k], self.memory[k] ] for k in
-                          self.diff_dicts(self.memory, orig_memory) ]
-        changes_registers = [[ f'reg {k}', orig_registers[k], self.registers[k] ] for k in
-                             self.diff_dicts(self.registers, orig_registers) ]
+        memory = defaultdict(lambda: None, self.memory.snapshot())
+        registers = defaultdict(lambda: None, self.register_items())
+        orig_registers = defaultdict(lambda: None, orig_registers)
+
+        changes_memory = [[ f'mem {k}', orig_memory[k], memory[k] ] for k in
+                          self.diff_dicts(memory, orig_memory) ]
+        changes_registers = [[ f'reg {k}', orig_registers[k], registers[k] ] for k in
+                             self.diff_dicts(registers, orig_registers) ]
         changes_variables = [[ f'var {k}', orig_variables[k], self.variables[k] ] for k in
                              self.diff_dicts(self.variables, orig_variables) ]
 
         all_changes = changes_memory + changes_registers + changes_variables
 
-        changes_df = pd.DataFrame(all_changes, columns=['Location', 'Old', 'New'])
-        
-        return changes_df
+        return Table(all_changes, columns=['Location', 'Old', 'New'])
+
+    def load_program(self, s):
+        """
+        Parses an x86 program and prepares to run it from "main", without
+        running any of it. Use resume to run the program.
+        :param s: An x86 program, as a string
+        """
+        self.code, self.labels = linearize(read_program(s))
+
+        for name in self.labels:
+            self.global_vals[name] = FunPointer(name)
+
+        self.pc = self.labels['main']
+        self.output = []
+
+    def resume(self, steps=None):
+        """
+        Runs the loaded program from where it stopped, until it finishes or
+        has executed steps more instructions. A run that stopped with an
+        ExecutionLimitExceeded can be resumed too, once the limit is raised.
+        :param steps: The number of instructions to run before suspending, or
+        None to run until the program finishes
+        :return: True if the program has finished, False if it was suspended
+        """
+        if self.pc is None:
+            return True
+
+        if steps is None:
+            self.stop_at = None
+        else:
+            self.stop_at = self.instructions_executed + steps
+
+        self.resumed_at = time.monotonic()
+        if self.time_limit is None:
+            self.deadline = None
+        else:
+            self.deadline = self.resumed_at + self.time_limit - self.run_time
+
+        try:
+            self.pc = self.run_code(self.pc, self.output)
+        finally:
+            self.run_time = self.run_time + time.monotonic() - self.resumed_at
+
+        return self.pc is None
+
+    def next_limit(self, executed, pc):
+        """
+        Called by the engines when the number of instructions executed reaches
+        the limit they are running to. Raises an ExecutionLimitExceeded when
+        the instruction budget or the time limit is used up.
+        :return: None if the run should be suspended at pc, otherwise the next
+        limit to run to
+        """
+        self.instructions_executed = executed
+        self.pc = pc
+        now = time.monotonic()
+
+        if self.max_instructions is not None and executed >= self.max_instructions:
+            raise InstructionLimitExceeded(f'Exceeded the limit of {self.max_instructions} instructions',
+                                           executed, self.run_time + now - self.resumed_at,
+                                           pc, self.label_at(pc), list(self.output))
+        if self.deadline is not None and now >= self.deadline:
+            raise TimeLimitExceeded(f'Exceeded the time limit of {self.time_limit} seconds',
+                                    executed, self.run_time + now - self.resumed_at,
+                                    pc, self.label_at(pc), list(self.output))
+        if self.stop_at is not None and executed >= self.stop_at:
+            return None
+
+        limit = sys.maxsize
+        if self.max_instructions is not None:
+            limit = min(limit, self.max_instructions)
+        if self.stop_at is not None:
+            limit = min(limit, self.stop_at)
+        if self.deadline is not None:
+            limit = min(limit, executed + TIME_CHECK_INTERVAL)
+        return limit
+
+    def label_at(self, pc):
+        """
+        Finds the label of the block containing position pc of the code.
+        """
+        label = None
+        for name, start in self.labels.items():
+            if start <= pc and (label is None or start >= self.labels[label]):
+                label = name
+        return label
 
     def diff_dicts(self, d_after, d_orig):
         keys_diff = []
@@ -101,252 +251,491 @@ class X86Emulator:
             if d_orig[k] != d_after[k]:
                 keys_diff.append(k)
         return keys_diff
+
+    def register_items(self):
+        items = []
+        for name, v in zip(REGISTERS, self.registers):
+            if v is not None:
+                if name == 'EFLAGS':
+                    v = FLAG_NAMES[v]
+                items.append((name, v))
+        return items
         
     def print_state(self):
-        pd.set_option("display.max_rows", None)
-        memory = [[ f'mem {k}', self.memory[k] ] for k in sorted(self.memory.keys()) ]
-        registers = [[ f'reg {k}', self.registers[k] ] for k in self.registers.keys() ]
+        memory = [[ f'mem {k}', v ] for k, v in self.memory.items() ]
+        registers = [[ f'reg {k}', v ] for k, v in self.register_items() ]
         variables = [[ f'var {k}', self.variables[k] ] for k in self.variables.keys() ]
         gvals = [[ f'{k}', self.global_vals[k] ] for k in self.global_vals.keys() ]
 
         all_state = memory + registers + variables + gvals
 
-        state_df = pd.DataFrame(all_state, columns=['Location', 'Value'])
-
-        return state_df
+        return Table(all_state, columns=['Location', 'Value'])
 
     def print_mem(self, mem):
         for k, v in mem.items():
             self.log(f' {k}:\t {v}')
 
-    def eval_imm(self, e):
-        if e.data == 'int_a':
-            return int(e.children[0])
-        elif e.data == 'neg_a':
-            return -self.eval_imm(e.children[0])
-        else:
-            raise Exception('eval_imm: unknown immediate:', e)
-
-    
     def eval_arg(self, a):
-        if a.data == 'reg_a':
-            return self.registers[str(a.children[0])]
-        elif a.data == 'var_a':
-            return self.variables[str(a.children[0])]
-        elif a.data == 'int_a':
-            return self.eval_imm(a.children[0])
-        elif a.data == 'mem_a':
-            offset, reg = a.children
-            addr = self.registers[reg]
-            offset_addr = addr + self.eval_imm(offset)
-            return self.memory[offset_addr]
-        elif a.data == 'global_val_a':
-            loc, reg = a.children
-            assert str(reg) == 'rip', a
-            return self.global_vals[str(loc)]
-
+        kind = a[0]
+        if kind == ARG_REG:
+            return self.registers[a[1]]
+        elif kind == ARG_IMM:
+            return a[1]
+        elif kind == ARG_MEM:
+            return self.memory.load(self.registers[a[1]] + a[2])
+        elif kind == ARG_VAR:
+            return self.variables[a[1]]
+        elif kind == ARG_GLOBAL:
+            return self.global_vals[a[1]]
         else:
             raise RuntimeError(f'Unknown arg in eval_arg: {a}')
 
     def store_arg(self, a, v):
-        if a.data == 'reg_a':
-            self.registers[str(a.children[0])] = v
-        elif a.data == 'var_a':
-            self.variables[str(a.children[0])] = v
-        elif a.data == 'mem_a':
-            offset, reg = a.children
-            addr = self.registers[reg]
-            offset_addr = addr + self.eval_imm(offset)
-            self.memory[offset_addr] = v
-        elif a.data == 'direct_mem_a':
-            reg = a.children[0]
-            addr = self.registers[reg]
-            self.memory[addr] = v
-        elif a.data == 'global_val_a':
-            loc, reg = a.children
-            assert str(reg) == 'rip', a
-            self.global_vals[str(loc)] = v
-
+        kind = a[0]
+        if kind == ARG_REG:
+            self.registers[a[1]] = v
+        elif kind == ARG_MEM:
+            self.memory.store(self.registers[a[1]] + a[2], v)
+        elif kind == ARG_VAR:
+            self.variables[a[1]] = v
+        elif kind == ARG_GLOBAL:
+            self.global_vals[a[1]] = v
         else:
             raise RuntimeError(f'Unknown arg in store_arg: {a}')
 
-    def eval_instrs(self, instrs, blocks, output):
-        for instr in instrs:
-            #log('Evaluating instruction:', instr.pretty())
-            if instr.data == 'pushq':
-                a = instr.children[0]
-                self.registers['rsp'] = self.registers['rsp'] - 8
-                v = self.eval_arg(a)
-                self.memory[self.registers['rsp']] = v
-
-            elif instr.data == 'popq':
-                a = instr.children[0]
-                v = self.memory[self.registers['rsp']]
-                self.registers['rsp'] = self.registers['rsp'] + 8
-                self.store_arg(a, v)
-
-            elif instr.data == 'movq':
-                a1, a2 = instr.children
-                v = self.eval_arg(a1)
-                self.store_arg(a2, v)
-
-            elif instr.data == 'movzbq':
-                a1, a2 = instr.children
-                v = self.eval_arg(a1)
-                self.store_arg(a2, v)
-
-            elif instr.data == 'addq':
-                a1, a2 = instr.children
-                v1 = self.eval_arg(a1)
-                v2 = self.eval_arg(a2)
-                self.store_arg(a2, v1 + v2)
-
-            elif instr.data == 'subq':
-                a1, a2 = instr.children
-                v1 = self.eval_arg(a1)
-                v2 = self.eval_arg(a2)
-                self.store_arg(a2, v2 - v1)
-
-            elif instr.data == 'xorq':
-                a1, a2 = instr.children
-                v1 = self.eval_arg(a1)
-                v2 = self.eval_arg(a2)
-                self.store_arg(a2, v1 ^ v2)
-
-            elif instr.data == 'negq':
-                a1 = instr.children[0]
-                v1 = self.eval_arg(a1)
-                self.store_arg(a1, (- v1))
-
-            elif instr.data in ['jmp', 'je', 'jl', 'jle', 'jg', 'jge']:
-                target = str(instr.children[0])
-                perform_jump = False
-
-                if instr.data == 'jmp':
-                    perform_jump = True
-                elif instr.data == 'je' and self.registers['EFLAGS'] == 'e':
-                    perform_jump = True
-                elif instr.data == 'jl' and self.registers['EFLAGS'] == 'l':
-                    perform_jump = True
-                elif instr.data == 'jle' and self.registers['EFLAGS'] in ['l', 'e']:
-                    perform_jump = True
-                elif instr.data == 'jg' and self.registers['EFLAGS'] == 'g':
-                    perform_jump = True
-                elif instr.data == 'jge' and self.registers['EFLAGS'] in ['g', 'e']:
-                    perform_jump = True
-
-                if perform_jump:
-                    self.eval_instrs(blocks[target], blocks, output)
-                    return # after jumping, toss continuation
-
-            elif instr.data in ['sete', 'setl', 'setle', 'setg', 'setge']:
-                a1 = instr.children[0]
-
-                if instr.data == 'sete' and self.registers['EFLAGS'] == 'e':
-                    self.store_arg(a1, 1)
-                elif instr.data == 'setl' and self.registers['EFLAGS'] == 'l':
-                    self.store_arg(a1, 1)
-                elif instr.data == 'setle' and self.registers['EFLAGS'] in ['l', 'e']:
-                    self.store_arg(a1, 1)
-                elif instr.data == 'setg' and self.registers['EFLAGS'] == 'g':
-                    self.store_arg(a1, 1)
-                elif instr.data == 'setge' and self.registers['EFLAGS'] in ['g', 'e']:
-                    self.store_arg(a1, 1)
-                else:
-                    self.store_arg(a1, 0)
-
-
-            elif instr.data == 'callq':
-                target = str(instr.children[0])
-                if target == 'print_int':
-                    self.log(f'CALL TO print_int: {self.registers["rdi"]}')
-                    output.append(self.registers['rdi'])
-                    if self.logging:
-                        print(self.print_state())
-
-                elif target == 'initialize':
-                    self.log(f'CALL TO initialize: {self.registers["rdi"]}, {self.registers["rsi"]}')
-                    rootstack_size = self.registers['rdi']
-                    heap_size = self.registers['rsi']
-
-                    rs_begin = 2000
-                    rs_end = rs_begin + rootstack_size
-
-                    fromspace_begin = 100000
-                    fromspace_end = fromspace_begin + heap_size
-
-                    self.global_vals = { **self.global_vals,
-                        'rootstack_begin': rs_begin,
-                        'rootstack_end': rs_end,
-                        'free_ptr': fromspace_begin,
-                        'fromspace_begin': fromspace_begin,
-                        'fromspace_end': fromspace_end
-                    }
-
-                    if self.logging:
-                        print(self.print_state())
-
-
-                elif target == 'collect':
-                    self.log(f'CALL TO collect: need {self.registers["rsi"]} bytes')
+    def call_runtime(self, name, output):
+        regs = self.registers
+
+        if name == 'print_int':
+            self.log(f'CALL TO print_int: {regs[RDI]}')
+            output.append(regs[RDI])
+            if self.logging:
+                print(self.print_state())
+
+        elif name == 'initialize':
+            self.log(f'CALL TO initialize: {regs[RDI]}, {regs[RSI]}')
+            rootstack_size = regs[RDI]
+            heap_size = regs[RSI]
+
+            rs_begin = ROOTSTACK_BEGIN
+            rs_end = rs_begin + rootstack_size
+
+            fromspace_begin = FROMSPACE_BEGIN
+            fromspace_end = fromspace_begin + heap_size
+
+            self.memory.add_segment('rootstack', rs_begin, rs_end)
+            self.memory.add_segment('heap', fromspace_begin, fromspace_end)
+
+            self.global_vals = { **self.global_vals,
+                'rootstack_begin': rs_begin,
+                'rootstack_end': rs_end,
+                'free_ptr': fromspace_begin,
+                'fromspace_begin': fromspace_begin,
+                'fromspace_end': fromspace_end
+            }
+
+            if self.logging:
+                print(self.print_state())
+
+
+        elif name == 'collect':
+            self.log(f'CALL TO collect: need {regs[RSI]} bytes')
+
+            # the collector's own memory accesses are not part of the profile
+            counts = self.memory.counts
+            self.memory.counts = None
+            stats = copy_collect(self.memory,
+                                 self.global_vals['rootstack_begin'],
+                                 regs[RDI],
+                                 self.global_vals['fromspace_begin'],
+                                 self.global_vals['fromspace_end'],
+                                 self.global_vals['free_ptr'],
+                                 regs[RSI],
+                                 FROMSPACE_BEGIN)
+            self.memory.counts = counts
+
+            self.global_vals['fromspace_begin'] = stats['fromspace_begin']
+            self.global_vals['fromspace_end'] = stats['fromspace_end']
+            self.global_vals['free_ptr'] = stats['free_ptr']
+
+            self.gc_stats.append({
+                'instructions_executed': self.instructions_executed,
+                'bytes_requested': regs[RSI],
+                'bytes_copied': stats['bytes_copied'],
+                'objects_live': stats['objects_copied'],
+                'roots': stats['roots'],
+                'words_scanned': stats['words_scanned'],
+                'heap_size': stats['fromspace_end'] - stats['fromspace_begin'],
+            })
+
+            self.log(f'GC STATS: {self.gc_stats[-1]}')
+            if self.logging:
+                print(self.print_state())
 
-                    needed = self.registers["rsi"]
-                    fsb = self.global_vals['fromspace_begin']
-                    fse = self.global_vals['fromspace_end']
-
-                    current_space = fse - fsb
-
-                    new_space = current_space
-                    while new_space - current_space < needed:
-                        new_space = new_space * 2
-
-                    new_fse = fsb + new_space
-                    self.global_vals['fromspace_end'] = new_fse
-
-                    if self.logging:
-                        print(self.print_state())
+        else:
+            raise RuntimeError(f'Unknown label: {name}')
+
+    def fun_target(self, v):
+        assert isinstance(v, FunPointer)
+        return self.labels[v.fun_name]
+
+    def run_code(self, pc, output):
+        """
+        Runs self.code starting at position pc, with the engine chosen when
+        the emulator was created. Profiling always uses eval_code, since the
+        counters are kept per instruction.
+        :return: The position to resume the run at, if it was suspended, or
+        None if the program finished
+        """
+        if self.compiled and self.profile is None:
+            return self.eval_blocks(pc, output)
+        else:
+            return self.eval_code(pc, output)
+
+    def eval_blocks(self, pc, output):
+        """
+        Runs self.code starting at position pc, like eval_code, but a basic
+        block at a time, using Python functions translated from the blocks.
+        """
+        code = self.code
+        code_end = len(code)
+
+        make_blocks, info = compile_program(code, self.labels)
+        memory = self.memory
+        stack = memory.stack
+        fns = make_blocks(self.registers, stack.words, stack.tags, stack.end - 8,
+                          memory.load, memory.store, memory.peek,
+                          self.return_stack, output, self.eval_arg, self.store_arg,
+                          self.call_runtime, self.fun_target, compare_failed, FunPointer, wrap)
+
+        # blocks[pc] is the block starting at pc, with its size and whether it
+        # ends with a call to the runtime
+        blocks = [None] * code_end
+        for fn, (start, size, calls_runtime) in zip(fns, info):
+            blocks[start] = (fn, size, calls_runtime)
+        starts = [start for start, size, calls_runtime in info]
+
+        executed = self.instructions_executed
+        limit = executed    # check the limits before the first block
+
+        try:
+            while pc < code_end:
+                block = blocks[pc]
+                if block is not None and executed + block[1] > limit:
+                    limit = self.next_limit(executed, pc)
+                    if limit is None:
+                        return pc
+
+                if block is None or executed + block[1] > limit:
+                    # the run resumes in the middle of this block, or has to
+                    # stop inside it, so run to the end of the block one
+                    # instruction at a time
+                    i = bisect.bisect_right(starts, pc)
+                    steps = (starts[i] if i < len(starts) else code_end) - pc
+
+                    self.instructions_executed = executed
+                    try:
+                        next_pc = self.eval_code(pc, output, steps)
+                    finally:
+                        ran = self.instructions_executed - executed
+                        executed = self.instructions_executed
+
+                    if next_pc is None or ran < steps:
+                        return next_pc
+                    pc = next_pc
+                    continue
+
+                fn, size, calls_runtime = block
+                executed = executed + size
+                if calls_runtime:
+                    self.instructions_executed = executed
+                pc = fn()
+        finally:
+            self.instructions_executed = executed
+
+        return None
+
+    def eval_code(self, pc, output, steps=None):
+        """
+        Runs self.code starting at position pc, until the outermost retq or
+        the end of the code.
+        :param pc: The position of the first instruction to run
+        :param output: The list that print_int appends to
+        :param steps: The most instructions to run before returning, or None
+        to run until the program finishes or is suspended
+        :return: The position of the next instruction to run, if the run was
+        suspended or ran the given number of steps, or None if the program
+        finished
+        """
+        code = self.code
+        code_end = len(code)
+        return_stack = self.return_stack
+        regs = self.registers
+        load = self.memory.load
+        store = self.memory.store
+        eval_arg = self.eval_arg
+
+        # words on the stack that already exist and hold integers are read and
+        # written here directly; everything else goes through load and store.
+        # When profiling, every access goes through load and store, so that
+        # it is counted.
+        profile = self.profile
+        stack = self.memory.stack
+        stack_words = stack.words
+        stack_tags = stack.tags if profile is None else bytearray()
+        stack_last = stack.end - 8
+        if profile is not None:
+            profile.set_labels(self.labels)
+        store_arg = self.store_arg
+
+        executed = self.instructions_executed
+        if steps is None:
+            stop = sys.maxsize
+        else:
+            stop = executed + steps
+        limit = executed    # check the limits before the first instruction
+
+        try:
+            # opcodes are tested roughly in order of how often compiled code
+            # executes them, and the common operand forms are handled inline
+            while pc < code_end:
+                if executed >= limit:
+                    if executed >= stop:
+                        return pc
+                    limit = self.next_limit(executed, pc)
+                    if limit is None:
+                        return pc
+                    limit = min(limit, stop)
+                executed = executed + 1
+
+                op, a1, a2 = code[pc]
+                if profile is not None:
+                    profile.step(pc, op)
+                pc = pc + 1
+
+                if op == MOVQ:
+                    kind = a1[0]
+                    if kind == ARG_REG:
+                        v = regs[a1[1]]
+                    elif kind == ARG_IMM:
+                        v = a1[1]
+                    elif kind == ARG_MEM:
+                        addr = regs[a1[1]] + a1[2]
+                        i = (stack_last - addr) >> 3
+                        if 0 <= i < len(stack_tags) and stack_tags[i] == INTEGER and not addr & 7:
+                            v = stack_words[i]
+                        else:
+                            v = load(addr)
+                    else:
+                        v = eval_arg(a1)
+
+                    kind = a2[0]
+                    if kind == ARG_REG:
+                        regs[a2[1]] = v
+                    elif kind == ARG_MEM:
+                        addr = regs[a2[1]] + a2[2]
+                        i = (stack_last - addr) >> 3
+                        if 0 <= i < len(stack_tags) and type(v) is int and \
+                                WORD_MIN <= v <= WORD_MAX and not addr & 7:
+                            stack_words[i] = v
+                            stack_tags[i] = INTEGER
+                        else:
+                            store(addr, v)
+                    else:
+                        store_arg(a2, v)
+
+                elif op == PUSHQ:
+                    rsp = regs[RSP] - 8
+                    regs[RSP] = rsp
+                    v = regs[a1[1]] if a1[0] == ARG_REG else eval_arg(a1)
+                    i = (stack_last - rsp) >> 3
+                    if 0 <= i < len(stack_tags) and type(v) is int and \
+                            WORD_MIN <= v <= WORD_MAX and not rsp & 7:
+                        stack_words[i] = v
+                        stack_tags[i] = INTEGER
+                    elif 0 <= i < len(stack_tags) and v is None and not rsp & 7:
+                        stack_tags[i] = UNINITIALIZED
+                    else:
+                        store(rsp, v)
+
+                elif op == POPQ:
+                    # callee-saved registers may be saved and restored before
+                    # they are ever written, so popq allows uninitialized words
+                    rsp = regs[RSP]
+                    i = (stack_last - rsp) >> 3
+                    if 0 <= i < len(stack_tags) and stack_tags[i] == INTEGER and not rsp & 7:
+                        v = stack_words[i]
+                    elif 0 <= i < len(stack_tags) and stack_tags[i] == UNINITIALIZED and not rsp & 7:
+                        v = None
+                    else:
+                        v = self.memory.peek(rsp)
+                    regs[RSP] = rsp + 8
+                    if a1[0] == ARG_REG:
+                        regs[a1[1]] = v
+                    else:
+                        store_arg(a1, v)
+
+                elif op == JMP:
+                    pc = a1
+
+                elif op == ADDQ:
+                    v1 = a1[1] if a1[0] == ARG_IMM else eval_arg(a1)
+                    v = (regs[a2[1]] if a2[0] == ARG_REG else eval_arg(a2)) + v1
+                    if not WORD_MIN <= v <= WORD_MAX:
+                        v = wrap(v)
+                    if a2[0] == ARG_REG:
+                        regs[a2[1]] = v
+                    else:
+                        store_arg(a2, v)
+
+                elif op == SUBQ:
+                    v1 = a1[1] if a1[0] == ARG_IMM else eval_arg(a1)
+                    v = (regs[a2[1]] if a2[0] == ARG_REG else eval_arg(a2)) - v1
+                    if not WORD_MIN <= v <= WORD_MAX:
+                        v = wrap(v)
+                    if a2[0] == ARG_REG:
+                        regs[a2[1]] = v
+                    else:
+                        store_arg(a2, v)
+
+                elif op == CMPQ:
+                    v1 = a1[1] if a1[0] == ARG_IMM else eval_arg(a1)
+                    v2 = regs[a2[1]] if a2[0] == ARG_REG else eval_arg(a2)
+
+                    if v1 == v2:
+                        regs[EFLAGS] = FLAG_E
+                    elif v2 < v1:
+                        regs[EFLAGS] = FLAG_L
+                    elif v2 > v1:
+                        regs[EFLAGS] = FLAG_G
+                    else:
+                        raise RuntimeError(f'failed comparison: {OPCODE_NAMES[op]} {a1}, {a2}')
+
+                elif op == JCC:
+                    if regs[EFLAGS] & a1:
+                        pc = a2
+
+                elif op == SETCC:
+                    if regs[EFLAGS] & a1:
+                        store_arg(a2, 1)
+                    else:
+                        store_arg(a2, 0)
+
+                elif op == MOVZBQ:
+                    store_arg(a2, eval_arg(a1))
+
+                elif op == XORQ:
+                    v1 = eval_arg(a1)
+                    v2 = eval_arg(a2)
+                    store_arg(a2, v1 ^ v2)
+
+                elif op == NEGQ:
+                    # - WORD_MIN is the only result that overflows
+                    store_arg(a1, wrap(- eval_arg(a1)))
+
+                elif op == LEAQ:
+                    v1 = eval_arg(a1)
+                    assert isinstance(v1, FunPointer)
+                    store_arg(a2, v1)
+
+                elif op == CALLQ:
+                    if profile is not None:
+                        profile.call(profile.block_starts[a1])
+                    return_stack.append(pc)
+                    pc = a1
+
+                elif op == RETQ:
+                    if return_stack:
+                        pc = return_stack.pop()
+                    else:
+                        return None # returning from the outermost call ends the run
+
+                elif op == INDIRECT_CALLQ:
+                    v = eval_arg(a1)
+                    if profile is not None:
+                        profile.call(v.fun_name)
+                    return_stack.append(pc)
+                    pc = self.fun_target(v)
+
+                elif op == INDIRECT_JMP:
+                    pc = self.fun_target(eval_arg(a1))
+
+                elif op == CALL_RUNTIME:
+                    if profile is not None:
+                        profile.call(a1)
+                    self.instructions_executed = executed
+                    self.call_runtime(a1, output)
 
                 else:
-                    self.eval_instrs(blocks[target], blocks, output)
-
-            elif instr.data == 'retq':
-                return
-
-            elif instr.data == 'cmpq':
-                a1, a2 = instr.children
-                v1 = self.eval_arg(a1)
-                v2 = self.eval_arg(a2)
-
-                if v1 == v2:
-                    self.registers['EFLAGS'] = 'e'
-                elif v2 < v1:
-                    self.registers['EFLAGS'] = 'l'
-                elif v2 > v1:
-                    self.registers['EFLAGS'] = 'g'
-                else:
-                    raise RuntimeError(f'failed comparison: {instr}')
+                    raise RuntimeError(f'Unknown instruction: {op}')
+        finally:
+            self.instructions_executed = executed
 
-            elif instr.data == 'leaq':
-                a1, a2 = instr.children
-                v1 = self.eval_arg(a1)
-                assert isinstance(v1, FunPointer)
-                self.store_arg(a2, v1)
+        return None
 
-            elif instr.data == 'indirect_callq':
-                v = self.eval_arg(instr.children[0])
-                assert isinstance(v, FunPointer)
-                target = v.fun_name
-                self.eval_instrs(blocks[target], blocks, output)
 
-            elif instr.data == 'indirect_jmp':
-                v = self.eval_arg(instr.children[0])
-                assert isinstance(v, FunPointer)
-                target = v.fun_name
-                self.eval_instrs(blocks[target], blocks, output)
-                return # after jumping, toss continuation
 
-            else:
-                raise RuntimeError(f'Unknown instruction: {instr.data}')
+##################################################
+# Running many programs
+##################################################
+
+@dataclass
+class BatchResult:
+    output: List[int]               # printed before the program stopped
+    error: Optional[str]            # None if the program ran to the end
+    time: float                     # seconds, including parsing
+    instructions_executed: int
+
+def eval_programs(programs, max_workers=None, **emulator_args) -> List[BatchResult]:
+    """
+    Runs many x86 programs in parallel, each in its own X86Emulator, using a
+    pool of worker processes.
+    :param programs: A list of x86 programs. Each is either the program text,
+    or the path of a .s file containing it (a path object, or a one-line string
+    ending in ".s")
+    :param max_workers: The number of worker processes; defaults to the
+    number of CPUs. With 1, the programs run in this process instead.
+    :param emulator_args: Passed on to X86Emulator, e.g. max_instructions,
+    time_limit or compiled. Logging is always off.
+    :return: A list with one BatchResult per program, in the same order
+    """
+    jobs = [(program, emulator_args) for program in programs]
+
+    if max_workers == 1:
+        _warm_up_worker()
+        return [_run_batch_job(job) for job in jobs]
+
+    # concurrent.futures is slow to import, so it is only loaded when needed
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_up_worker) as pool:
+        return list(pool.map(_run_batch_job, jobs, chunksize=chunksize))
+
+def _warm_up_worker():
+    # read a small program, so that the first real program in each worker
+    # does not pay for loading the reader
+    read_program(prog1)
+
+def _run_batch_job(job) -> BatchResult:
+    program, emulator_args = job
+    start = time.perf_counter()
+    emu = X86Emulator(logging=False, **emulator_args)
+
+    try:
+        if isinstance(program, os.PathLike) or \
+                ('\n' not in program and program.endswith('.s')):
+            with open(program) as f:
+                program = f.read()
+
+        emu.eval_program(program)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+
+    return BatchResult(emu.output, error, time.perf_counter() - start,
+                       emu.instructions_executed)
 
 
 
@@ -473,7 +862,7 @@ instrs = ['movq $1, %rax',
           'addq $2, %rax',
           'addq $3, %rax',
           'addq $5, %rax\n movq %rax, %rdi',
-          'movq $42, (%rax)']
+          'movq %rsp, %rax\n movq $42, -8(%rax)']
 
 if __name__ == "__main__":
     for prog in prog1, prog2, prog3, prog4, prog5:
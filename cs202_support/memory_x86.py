@@ -0,0 +1,181 @@
+from array import array
+from typing import Any, Dict, List, Tuple
+
+# Memory for the x86 emulator, split into segments (the stack, the root stack
+# and the heap). Each segment stores 8-byte words in an array('q') that grows
+# as the program touches more of the segment. A parallel bytearray of tags
+# records what each word holds:
+
+UNINITIALIZED = 0
+INTEGER = 1
+OBJECT = 2      # a Python value such as a FunPointer, stored by reference
+
+WORD_MIN = -2**63
+WORD_MAX = 2**63 - 1
+
+class MemoryAccessError(RuntimeError):
+    pass
+
+def wrap(v: int) -> int:
+    """
+    Wraps an integer around to a signed 64-bit word, as the x86 arithmetic
+    instructions do. The engines call it on every result that overflows, so
+    that a value is the same in a register and in memory.
+    """
+    return ((v - WORD_MIN) % 2**64) + WORD_MIN
+
+class Segment:
+    """
+    A range of addresses [start, end). A segment that grows down (the stack)
+    allocates its words starting from the end of the range.
+    """
+    def __init__(self, name: str, start: int, end: int, grows_down=False):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.grows_down = grows_down
+        self.words = array('q')
+        self.tags = bytearray()
+
+    def index(self, addr: int) -> int:
+        if self.grows_down:
+            return (self.end - 8 - addr) >> 3
+        else:
+            return (addr - self.start) >> 3
+
+    def address(self, index: int) -> int:
+        if self.grows_down:
+            return self.end - 8 - (index << 3)
+        else:
+            return self.start + (index << 3)
+
+    def grow(self, index: int):
+        # at least double the allocated words, so that growing stays cheap
+        new_len = max(index + 1, 2 * len(self.words), 64)
+        new_len = min(new_len, (self.end - self.start) >> 3)
+        extra = new_len - len(self.words)
+        self.words.frombytes(bytes(8 * extra))
+        self.tags.extend(bytes(extra))
+
+
+class Memory:
+    """
+    The emulator's memory. Addresses must be 8-byte aligned and fall inside
+    one of the segments; reading a word that was never written is an error.
+    """
+    def __init__(self, stack_top: int, stack_size: int):
+        self.stack = Segment('stack', stack_top - stack_size, stack_top, grows_down=True)
+        self.segments: List[Segment] = [self.stack]
+        self.objects: List[Any] = []
+        self.object_ids: Dict[int, int] = {}
+
+        # when set (by the emulator's profiling mode), a dict of load and
+        # store counts by segment name
+        self.counts = None
+
+    def add_segment(self, name: str, start: int, end: int) -> Segment:
+        for s in self.segments:
+            if start < s.end and s.start < end:
+                raise MemoryAccessError(f'segment {name} overlaps segment {s.name}')
+
+        segment = Segment(name, start, end)
+        self.segments.append(segment)
+        return segment
+
+    def remove_segment(self, name: str):
+        self.segments = [s for s in self.segments if s.name != name]
+
+    def get_segment(self, name: str) -> Segment:
+        for s in self.segments:
+            if s.name == name:
+                return s
+        raise MemoryAccessError(f'no segment named {name}')
+
+    def locate(self, addr: int) -> Tuple[Segment, int]:
+        """
+        Finds the segment containing addr, and the index of addr's word in it.
+        """
+        if addr & 7:
+            raise MemoryAccessError(f'unaligned memory access at address {addr}')
+
+        for s in self.segments:
+            if s.start <= addr < s.end:
+                i = s.index(addr)
+                if i >= len(s.tags):
+                    s.grow(i)
+                return s, i
+
+        raise MemoryAccessError(f'memory access out of range at address {addr}')
+
+    def find(self, addr: int) -> Tuple[Segment, int]:
+        # the stack is checked first, since most accesses go there
+        s = self.stack
+        i = (s.end - 8 - addr) >> 3
+        if 0 <= i < len(s.tags) and not addr & 7:
+            return s, i
+        else:
+            return self.locate(addr)
+
+    def peek(self, addr: int) -> Any:
+        """
+        Reads the word at addr, returning None if it was never written.
+        """
+        s, i = self.find(addr)
+        if self.counts is not None:
+            self.counts['loads'][s.name] += 1
+        tag = s.tags[i]
+        if tag == INTEGER:
+            return s.words[i]
+        elif tag == OBJECT:
+            return self.objects[s.words[i]]
+        else:
+            return None
+
+    def load(self, addr: int) -> Any:
+        s, i = self.find(addr)
+        if self.counts is not None:
+            self.counts['loads'][s.name] += 1
+        tag = s.tags[i]
+        if tag == INTEGER:
+            return s.words[i]
+        elif tag == OBJECT:
+            return self.objects[s.words[i]]
+        else:
+            raise MemoryAccessError(f'read of uninitialized memory at address {addr} ({s.name})')
+
+    def store(self, addr: int, v: Any):
+        s, i = self.find(addr)
+        if self.counts is not None:
+            self.counts['stores'][s.name] += 1
+        if isinstance(v, int):
+            if WORD_MIN <= v <= WORD_MAX:
+                s.words[i] = v
+            else:
+                s.words[i] = wrap(v)
+            s.tags[i] = INTEGER
+        elif v is None:
+            s.tags[i] = UNINITIALIZED
+        else:
+            key = id(v)
+            if key not in self.object_ids:
+                self.object_ids[key] = len(self.objects)
+                self.objects.append(v)
+            s.words[i] = self.object_ids[key]
+            s.tags[i] = OBJECT
+
+    def items(self) -> List[Tuple[int, Any]]:
+        """
+        Lists the (address, value) pairs of all initialized words, sorted by
+        address.
+        """
+        result = []
+        for s in self.segments:
+            for i, tag in enumerate(s.tags):
+                if tag == INTEGER:
+                    result.append((s.address(i), s.words[i]))
+                elif tag == OBJECT:
+                    result.append((s.address(i), self.objects[s.words[i]]))
+        return sorted(result)
+
+    def snapshot(self) -> Dict[int, Any]:
+        return dict(self.items())
@@ -1,6 +1,8 @@
-from lark import Lark
+# The grammar of the x86 programs emitted by the compiler, used by the
+# emulator for programs that reader_x86.py does not handle. The parsers are
+# built the first time they are used, since building them is slow.
 
-x86_parser = Lark(r"""
+x86_grammar = r"""
     ?instr: "movq" arg "," arg -> movq
           | "addq" arg "," arg -> addq
           | "subq" arg "," arg -> subq
@@ -21,7 +23,6 @@ x86_parser = Lark(r"""
           | "setg" arg -> setg
           | "setge" arg -> setge
           | "movzbq" arg "," arg -> movzbq
-          | "xorq" arg "," arg -> xorq
           | "callq" CNAME -> callq
           | "callq" "*" arg -> indirect_callq
           | "pushq" arg -> pushq
@@ -48,61 +49,33 @@ x86_parser = Lark(r"""
 
     prog: block*
 
-    %import common.NUMBER
-    %import common.CNAME
-
-    %import common.WS
-    %ignore WS
-    """, start='prog', parser='lalr')
-
-x86_parser_instrs = Lark(r"""
-    ?instr: "movq" arg "," arg -> movq
-          | "addq" arg "," arg -> addq
-          | "subq" arg "," arg -> subq
-          | "cmpq" arg "," arg -> cmpq
-          | "xorq" arg "," arg -> xorq
-          | "leaq" arg "," arg -> leaq
-          | "negq" arg -> negq
-          | "jmp" CNAME -> jmp
-          | "jmp" "*" arg -> indirect_jmp
-          | "je" CNAME -> je
-          | "jl" CNAME -> jl
-          | "jle" CNAME -> jle
-          | "jg" CNAME -> jg
-          | "jge" CNAME -> jge
-          | "sete" arg -> sete
-          | "setl" arg -> setl
-          | "setle" arg -> setle
-          | "setg" arg -> setg
-          | "setge" arg -> setge
-          | "movzbq" arg "," arg -> movzbq
-          | "xorq" arg "," arg -> xorq
-          | "callq" CNAME -> callq
-          | "callq" "*" arg -> indirect_callq
-          | "pushq" arg -> pushq
-          | "popq" arg -> popq
-          | "retq" -> retq
-
     instrs: instr*
 
-    ?arg: "$" atom -> int_a
-        | "%" reg -> reg_a
-        | "#" CNAME -> var_a
-        | "(" "%" reg ")" -> direct_mem_a
-        | atom "(" "%" reg ")" -> mem_a
-        | CNAME "(" "%" reg ")" -> global_val_a
-
-    ?atom: NUMBER -> int_a
-         | "-" atom  -> neg_a
-
-    !?reg: "rsp" | "rbp" | "rax" | "rbx" | "rcx" | "rdx" | "rsi" | "rdi" 
-         | "r8" | "r9" | "r10" | "r11" | "r12" | "r13" | "r14" | "r15"
-         | "al" | "rip"
-
     %import common.NUMBER
     %import common.CNAME
 
     %import common.WS
     %ignore WS
-    """, start='instrs', parser='lalr')
-
+    """
+
+_parsers = {}
+
+def get_parser(start: str):
+    """
+    Returns the LALR parser for the x86 grammar with the given start rule
+    ("prog" for whole programs, "instrs" for lists of instructions), building
+    it the first time it is asked for.
+    """
+    if start not in _parsers:
+        from lark import Lark
+        _parsers[start] = Lark(x86_grammar, start=start, parser='lalr')
+    return _parsers[start]
+
+def __getattr__(name):
+    # x86_parser and x86_parser_instrs are built on first use
+    if name == 'x86_parser':
+        return get_parser('prog')
+    elif name == 'x86_parser_instrs':
+        return get_parser('instrs')
+    else:
+        raise AttributeError(f'module {__name__} has no attribute {name}')
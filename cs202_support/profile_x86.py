@@ -0,0 +1,47 @@
+import json
+from collections import defaultdict
+from typing import Any, Dict
+
+from .decode_x86 import OPCODE_NAMES
+
+class Profile:
+    """
+    Execution counters collected by X86Emulator when it is created with
+    profile=True: instructions by opcode, entries into each block, call
+    targets, and memory loads and stores by segment.
+    """
+    def __init__(self):
+        self.opcode_counts = [0] * len(OPCODE_NAMES)
+        self.block_counts: Dict[str, int] = defaultdict(int)
+        self.call_counts: Dict[str, int] = defaultdict(int)
+        self.memory_counts = {
+            'loads': defaultdict(int),
+            'stores': defaultdict(int),
+        }
+        self.block_starts: Dict[int, str] = {}
+
+    def set_labels(self, labels: Dict[str, int]):
+        # labels of empty blocks share a position with the next block; the
+        # later label wins, since it is the one with instructions
+        self.block_starts = {pc: label for label, pc in labels.items()}
+
+    def step(self, pc: int, op: int):
+        self.opcode_counts[op] = self.opcode_counts[op] + 1
+        label = self.block_starts.get(pc)
+        if label is not None:
+            self.block_counts[label] = self.block_counts[label] + 1
+
+    def call(self, target: str):
+        self.call_counts[target] = self.call_counts[target] + 1
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'instructions': sum(self.opcode_counts),
+            'opcodes': {OPCODE_NAMES[op]: n for op, n in enumerate(self.opcode_counts) if n > 0},
+            'blocks': dict(self.block_counts),
+            'calls': dict(self.call_counts),
+            'memory': {kind: dict(counts) for kind, counts in self.memory_counts.items()},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2, sort_keys=True)
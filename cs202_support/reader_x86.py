@@ -0,0 +1,175 @@
+import re
+from typing import Dict, List
+
+from .decode_x86 import *
+
+# A reader for the line-oriented x86 that print_x86 emits. It reads a program
+# straight into the decoded form used by the emulator (see decode_x86.py),
+# one line at a time, without building a parse tree. Each line must hold one
+# directive, label or instruction in the usual spelling:
+#
+#   .globl main
+#   main:
+#     movq $42, -8(%rbp)
+#
+# Anything else (several instructions on one line, unusual spacing, syntax
+# errors) makes the reader give up, and the program is parsed by the Lark
+# grammars in parser_x86.py instead, which are only built when needed.
+
+class ReadError(Exception):
+    pass
+
+_name = re.compile(r'[A-Za-z_][A-Za-z_0-9]*\Z')
+_number = re.compile(r'-*[0-9]+\Z')
+
+_jumps = {'j' + cc: mask for cc, mask in CONDITION_MASKS.items()}
+_sets = {'set' + cc: mask for cc, mask in CONDITION_MASKS.items()}
+
+# every register name the grammar accepts
+_registers = {name: i for name, i in REGISTER_INDEX.items() if name != 'EFLAGS'}
+
+def read_imm(s: str) -> int:
+    # the grammar allows any number of leading minus signs
+    if not _number.match(s):
+        raise ReadError(s)
+    digits = s.lstrip('-')
+    if (len(s) - len(digits)) % 2 == 1:
+        return -int(digits)
+    else:
+        return int(digits)
+
+def read_reg(s: str) -> int:
+    if s in _registers:
+        return _registers[s]
+    else:
+        raise ReadError(s)
+
+def read_arg(s: str) -> Operand:
+    if s.startswith('%'):
+        return (ARG_REG, read_reg(s[1:]))
+    elif s.startswith('$'):
+        return (ARG_IMM, read_imm(s[1:]))
+    elif s.startswith('#'):
+        if not _name.match(s[1:]):
+            raise ReadError(s)
+        return (ARG_VAR, s[1:])
+    elif s.endswith(')'):
+        offset, paren, reg = s[:-1].partition('(%')
+        if paren == '':
+            raise ReadError(s)
+        elif offset == '':
+            return (ARG_MEM, read_reg(reg), 0)
+        elif _name.match(offset):
+            if reg != 'rip':
+                raise ReadError(s)
+            return (ARG_GLOBAL, offset)
+        else:
+            return (ARG_MEM, read_reg(reg), read_imm(offset))
+    else:
+        raise ReadError(s)
+
+def read_instr(line: str) -> DecodedInstr:
+    name, _, rest = line.partition(' ')
+    args = rest.split(', ') if rest else []
+
+    if name in ('movq', 'addq', 'subq', 'cmpq', 'movzbq', 'xorq', 'leaq') and len(args) == 2:
+        op = {'movq': MOVQ, 'addq': ADDQ, 'subq': SUBQ, 'cmpq': CMPQ,
+              'movzbq': MOVZBQ, 'xorq': XORQ, 'leaq': LEAQ}[name]
+        return (op, read_arg(args[0]), read_arg(args[1]))
+    elif name in ('negq', 'pushq', 'popq') and len(args) == 1:
+        op = {'negq': NEGQ, 'pushq': PUSHQ, 'popq': POPQ}[name]
+        return (op, read_arg(args[0]), None)
+    elif name in ('jmp', 'callq') and len(args) == 1:
+        target = args[0]
+        if target.startswith('*'):
+            op = INDIRECT_JMP if name == 'jmp' else INDIRECT_CALLQ
+            return (op, read_arg(target[1:]), None)
+        elif _name.match(target):
+            return (JMP if name == 'jmp' else CALLQ, target, None)
+        else:
+            raise ReadError(line)
+    elif name in _jumps and len(args) == 1 and _name.match(args[0]):
+        return (JCC, _jumps[name], args[0])
+    elif name in _sets and len(args) == 1:
+        return (SETCC, _sets[name], read_arg(args[0]))
+    elif name == 'retq' and not args:
+        return (RETQ, None, None)
+    else:
+        raise ReadError(line)
+
+def read_lines(s: str, labels: bool) -> Dict[str, List[DecodedInstr]]:
+    """
+    Reads the lines of s into a dict mapping block labels to decoded
+    instructions. Without labels, all instructions go in a block named
+    "instrs".
+    """
+    blocks = {}
+    current = None
+    if not labels:
+        current = blocks['instrs'] = []
+
+    # the same instructions appear many times in a program, so each distinct
+    # line is only decoded once
+    decoded = {}
+
+    for line in s.splitlines():
+        line = line.strip()
+        if line == '':
+            continue
+        elif line in decoded:
+            if current is None:
+                raise ReadError(line)
+            current.append(decoded[line])
+        elif labels and line.endswith(':') and _name.match(line[:-1]):
+            current = blocks[line[:-1]] = []
+        elif labels and line.startswith('.'):
+            # the grammar parses a directive as a block with no instructions,
+            # named after the directive's argument, and decode_program keeps
+            # that block; it is kept here too, so that both lay out programs
+            # the same way
+            directive, _, arg = line.partition(' ')
+            if directive == '.globl' and _name.match(arg):
+                blocks[arg] = []
+            elif directive == '.align' and arg.isdigit():
+                blocks[arg] = []
+            else:
+                raise ReadError(line)
+            current = None
+        else:
+            if current is None:
+                raise ReadError(line)
+            instr = read_instr(line)
+            decoded[line] = instr
+            current.append(instr)
+
+    return blocks
+
+def read_program(s: str) -> Dict[str, List[DecodedInstr]]:
+    """
+    Reads an x86 program into a dict mapping each block label to its list of
+    decoded instructions, like decode_program. Input the reader does not
+    handle is parsed with the Lark grammar instead.
+    :param s: An x86 program, as a string
+    :return: A dict of decoded blocks, in program order
+    """
+    try:
+        return read_lines(s, labels=True)
+    except ReadError:
+        from .parser_x86 import x86_parser
+        return decode_program(x86_parser.parse(s))
+
+def read_instrs(s: str) -> List[DecodedInstr]:
+    """
+    Reads a sequence of x86 instructions, without labels, into a list of
+    decoded instructions. Input the reader does not handle is parsed with the
+    Lark grammar instead.
+    :param s: x86 instructions, as a string
+    :return: A list of decoded instructions
+    """
+    try:
+        return read_lines(s, labels=False)['instrs']
+    except ReadError:
+        from .parser_x86 import x86_parser_instrs
+        p = x86_parser_instrs.parse(s)
+        assert p.data == 'instrs'
+        return decode_instrs(p.children)
@@ -0,0 +1,37 @@
+from typing import Any, List
+
+class Table:
+    """
+    A small table of rows, printed with aligned columns. Used for the
+    emulator's state dumps in place of a pandas DataFrame.
+    """
+    def __init__(self, rows: List[List[Any]], columns: List[str]):
+        self.rows = rows
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __str__(self):
+        # the first column is the row number, like a DataFrame's index
+        header = [''] + self.columns
+        body = [[str(i)] + [str(v) for v in row] for i, row in enumerate(self.rows)]
+
+        widths = [len(h) for h in header]
+        for row in body:
+            widths = [max(w, len(v)) for w, v in zip(widths, row)]
+
+        lines = []
+        for row in [header] + body:
+            cells = [row[0].ljust(widths[0])] + \
+                    [v.rjust(w) for v, w in zip(row[1:], widths[1:])]
+            lines.append('  '.join(cells))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return str(self)
+
+    def to_dataframe(self):
+        # pandas is slow to import, so it is only loaded when asked for
+        import pandas as pd
+        return pd.DataFrame(self.rows, columns=self.columns)
@@ -0,0 +1,274 @@
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+from .decode_x86 import *
+from .memory_x86 import UNINITIALIZED, INTEGER, OBJECT, WORD_MIN, WORD_MAX
+
+# Translation of linearized x86 code into Python functions, one per basic
+# block. Each function runs the instructions of its block and returns the
+# position of the next block to run:
+#
+#   def block_12():
+#       r2 = regs[2]
+#       r2 = r2 + 1
+#       r5 = r2
+#       regs[2] = r2
+#       regs[5] = r5
+#       return 15
+#
+# Words on the stack that already exist are read and written directly, as in
+# eval_code's fast path; other memory accesses go through the memory's load,
+# store and peek. Operands that are rare in compiled code (variables and
+# globals) use the emulator's eval_arg and store_arg, so they behave exactly
+# as in the interpreter.
+
+# instructions that end a basic block
+_block_enders = {JMP, JCC, CALLQ, RETQ, INDIRECT_CALLQ, INDIRECT_JMP, CALL_RUNTIME}
+
+def block_starts(code: List[DecodedInstr], labels: Dict[str, int]) -> List[int]:
+    """
+    Finds the first instruction of each basic block: every labeled position,
+    every jump or call target, and every instruction following one that ends
+    a block.
+    """
+    starts = {0}
+    starts.update(labels.values())
+    for pc, (op, a1, a2) in enumerate(code):
+        if op in _block_enders:
+            starts.add(pc + 1)
+        if op == JMP or op == CALLQ:
+            starts.add(a1)
+        elif op == JCC:
+            starts.add(a2)
+
+    return sorted(pc for pc in starts if pc < len(code))
+
+def translate_block(code: List[DecodedInstr], start: int, end: int) -> List[str]:
+    """
+    Translates the instructions code[start:end] into the lines of the body of
+    a Python function. Registers are kept in local variables (r0, r1, ...)
+    inside the block, and written back to the register list when the block
+    exits or calls the runtime.
+    """
+    lines = []
+    loaded = set()      # registers read before the block writes them
+    written = set()     # registers the block writes
+    temps = 0
+
+    def reg(r: int) -> str:
+        if r not in written:
+            loaded.add(r)
+        return f'r{r}'
+
+    def set_reg(r: int, v: str):
+        lines.append(f'r{r} = {v}')
+        written.add(r)
+
+    def write_back():
+        for r in sorted(written):
+            lines.append(f'regs[{r}] = r{r}')
+
+    def new_temp() -> str:
+        nonlocal temps
+        temps = temps + 1
+        return f't{temps}'
+
+    def address(a):
+        # computes the address of a memory operand, and its index in the stack
+        lines.append(f'a = {reg(a[1])} + {a[2]}')
+        lines.append(f'i = (stack_last - a) >> 3')
+
+    def read(a) -> str:
+        kind = a[0]
+        if kind == ARG_REG:
+            return reg(a[1])
+        elif kind == ARG_IMM:
+            return repr(a[1])
+        elif kind == ARG_MEM:
+            t = new_temp()
+            address(a)
+            lines.append(f'if 0 <= i < len(stack_tags) and stack_tags[i] == {INTEGER} and not a & 7:')
+            lines.append(f'    {t} = stack_words[i]')
+            lines.append(f'else:')
+            lines.append(f'    {t} = load(a)')
+            return t
+        else:
+            return f'eval_arg({a!r})'
+
+    def write(a, v: str):
+        kind = a[0]
+        if kind == ARG_REG:
+            set_reg(a[1], v)
+        elif kind == ARG_MEM:
+            lines.append(f'v = {v}')
+            address(a)
+            store_word('a')
+        else:
+            lines.append(f'store_arg({a!r}, {v})')
+
+    def store_word(addr: str, allow_none=False):
+        # stores v at addr, where i is the index of addr in the stack
+        lines.append(f'if 0 <= i < len(stack_tags) and type(v) is int and '
+                     f'{WORD_MIN} <= v <= {WORD_MAX} and not {addr} & 7:')
+        lines.append(f'    stack_words[i] = v')
+        lines.append(f'    stack_tags[i] = {INTEGER}')
+        if allow_none:
+            # callee-saved registers may be pushed before they are ever written
+            lines.append(f'elif v is None and 0 <= i < len(stack_tags) and not {addr} & 7:')
+            lines.append(f'    stack_tags[i] = {UNINITIALIZED}')
+        lines.append(f'else:')
+        lines.append(f'    store({addr}, v)')
+
+    def wrap_v():
+        # arithmetic wraps around to 64 bits, in registers as in memory
+        lines.append(f'if not {WORD_MIN} <= v <= {WORD_MAX}:')
+        lines.append(f'    v = wrap(v)')
+
+    def exit_to(target: str):
+        write_back()
+        lines.append(f'return {target}')
+
+    for pc in range(start, end):
+        op, a1, a2 = code[pc]
+        next_pc = pc + 1
+
+        if op == MOVQ or op == MOVZBQ:
+            write(a2, read(a1))
+
+        elif op == PUSHQ:
+            set_reg(RSP, f'{reg(RSP)} - 8')
+            lines.append(f'v = {read(a1)}')
+            lines.append(f'i = (stack_last - r{RSP}) >> 3')
+            store_word(f'r{RSP}', allow_none=True)
+
+        elif op == POPQ:
+            # and popq allows uninitialized words, for the same reason
+            lines.append(f'i = (stack_last - {reg(RSP)}) >> 3')
+            lines.append(f'if 0 <= i < len(stack_tags) and not r{RSP} & 7 and stack_tags[i] != {OBJECT}:')
+            lines.append(f'    v = stack_words[i] if stack_tags[i] == {INTEGER} else None')
+            lines.append(f'else:')
+            lines.append(f'    v = peek(r{RSP})')
+            set_reg(RSP, f'r{RSP} + 8')
+            write(a1, 'v')
+
+        elif op == ADDQ or op == SUBQ:
+            sign = '+' if op == ADDQ else '-'
+            v = read(a1)
+            if a1[0] == ARG_MEM:
+                t = new_temp()
+                lines.append(f'{t} = {v}')
+                v = t
+            lines.append(f'v = {read(a2)} {sign} {v}')
+            wrap_v()
+            write(a2, 'v')
+
+        elif op == CMPQ:
+            v1 = read(a1)
+            v2 = read(a2)
+            set_reg(EFLAGS, f'{FLAG_E} if {v1} == {v2} else {FLAG_L} if {v2} < {v1} else '
+                            f'{FLAG_G} if {v2} > {v1} else compare_failed({a1!r}, {a2!r})')
+
+        elif op == SETCC:
+            write(a2, f'1 if {reg(EFLAGS)} & {a1} else 0')
+
+        elif op == XORQ:
+            v1 = read(a1)
+            if a1[0] == ARG_MEM:
+                t = new_temp()
+                lines.append(f'{t} = {v1}')
+                v1 = t
+            write(a2, f'{v1} ^ {read(a2)}')
+
+        elif op == NEGQ:
+            lines.append(f'v = -{read(a1)}')
+            wrap_v()
+            write(a1, 'v')
+
+        elif op == LEAQ:
+            lines.append(f'v = {read(a1)}')
+            lines.append(f'assert isinstance(v, FunPointer)')
+            write(a2, 'v')
+
+        elif op == JMP:
+            exit_to(str(a1))
+
+        elif op == JCC:
+            exit_to(f'{a2} if {reg(EFLAGS)} & {a1} else {next_pc}')
+
+        elif op == CALLQ:
+            lines.append(f'return_stack.append({next_pc})')
+            exit_to(str(a1))
+
+        elif op == RETQ:
+            # returning from the outermost call ends the run
+            exit_to(f'return_stack.pop() if return_stack else {len(code)}')
+
+        elif op == INDIRECT_CALLQ:
+            lines.append(f'v = {read(a1)}')
+            lines.append(f'return_stack.append({next_pc})')
+            exit_to('fun_target(v)')
+
+        elif op == INDIRECT_JMP:
+            exit_to(f'fun_target({read(a1)})')
+
+        elif op == CALL_RUNTIME:
+            write_back()
+            lines.append(f'call_runtime({a1!r}, output)')
+            lines.append(f'return {next_pc}')
+
+        else:
+            raise RuntimeError(f'Unknown instruction: {op}')
+
+    if code[end - 1][0] not in _block_enders:
+        # falls through into the next block
+        exit_to(str(end))
+
+    return [f'r{r} = regs[{r}]' for r in sorted(loaded)] + lines
+
+def translate_program(code: List[DecodedInstr], labels: Dict[str, int]) -> Tuple[str, List[Tuple[int, int, bool]]]:
+    """
+    Translates linearized code into the source of a Python function,
+    make_blocks, which builds one function per basic block.
+    :param code: A list of instructions, laid out by linearize
+    :param labels: A dict mapping labels to positions in code
+    :return: A Tuple. The first element is the source of make_blocks. The
+    second lists (start, size, calls_runtime) for each block, in the order of
+    the functions returned by make_blocks.
+    """
+    starts = block_starts(code, labels)
+    ends = starts[1:] + [len(code)]
+
+    source = ['def make_blocks(regs, stack_words, stack_tags, stack_last, load, store, peek,',
+              '                return_stack, output, eval_arg, store_arg, call_runtime,',
+              '                fun_target, compare_failed, FunPointer, wrap):']
+    info = []
+
+    for start, end in zip(starts, ends):
+        source.append(f'    def block_{start}():')
+        for line in translate_block(code, start, end):
+            source.append('        ' + line)
+        info.append((start, end - start, code[end - 1][0] == CALL_RUNTIME))
+
+    names = ', '.join(f'block_{start}' for start in starts)
+    source.append(f'    return [{names}]')
+    return '\n'.join(source) + '\n', info
+
+def compile_program(code: List[DecodedInstr], labels: Dict[str, int]) -> Tuple[Callable, List[Tuple[int, int, bool]]]:
+    """
+    Translates linearized code with translate_program and compiles the
+    result. Recently compiled programs are cached, since tests and batch runs
+    often emulate the same program many times.
+    :return: A Tuple of the make_blocks function and the block information
+    returned by translate_program
+    """
+    return _compile_program(tuple(code), tuple(sorted(labels.items())))
+
+@lru_cache(maxsize=32)
+def _compile_program(code, labels):
+    source, info = translate_program(list(code), dict(labels))
+    namespace = {}
+    exec(compile(source, '<x86 blocks>', 'exec'), namespace)
+    return namespace['make_blocks'], info
+
+def compare_failed(a1: Operand, a2: Operand):
+    raise RuntimeError(f'failed comparison: cmpq {a1}, {a2}')
@@ -38,7 +38,7 @@ class FunVal:
     body: RfunExp
 
 def eval_rfun(program: RfunProgram):
-    def eval_e(e: RfunExp, env: Dict[str, Any]):
+    def eval_e(e: RfunExp, env: Dict[str, Any]) -> Iterative[Any]:
         if isinstance(e, Int):
             return e.val
         if isinstance(e, Bool):
@@ -46,31 +46,34 @@ def eval_rfun(program: RfunProgram):
         elif isinstance(e, Var):
             return env[e.var]
         elif isinstance(e, Let):
-            new_env = {**env, e.x: eval_e(e.e1, env)}
-            return eval_e(e.body, new_env)
+            v = yield eval_e(e.e1, env)
+            with bind(env, e.x, v):
+                return (yield eval_e(e.body, env))
         elif isinstance(e, Prim):
             if e.op in binops:
                 e1, e2 = e.args
                 f = binops[e.op]
-                return f(eval_e(e1, env), eval_e(e2, env))
+                v1 = yield eval_e(e1, env)
+                v2 = yield eval_e(e2, env)
+                return f(v1, v2)
             elif e.op in unops:
                 e1 = e.args[0]
                 f = unops[e.op]
-                return f(eval_e(e1, env))
+                return f((yield eval_e(e1, env)))
             elif e.op == 'vector':
-                vals = [eval_e(a, env) for a in e.args]
+                vals = yield [eval_e(a, env) for a in e.args]
                 return VectorVal(vals)
             elif e.op == 'vectorRef':
                 e1, idx = e.args
-                v1 = eval_e(e1, env)
+                v1 = yield eval_e(e1, env)
                 assert isinstance(v1, VectorVal)
                 assert isinstance(idx, Int)
 
                 return v1.values[idx.val]
             elif e.op == 'vectorSet':
                 e1, idx, e2 = e.args
-                v1 = eval_e(e1, env)
-                v2 = eval_e(e2, env)
+                v1 = yield eval_e(e1, env)
+                v2 = yield eval_e(e2, env)
                 assert isinstance(v1, VectorVal)
                 assert isinstance(idx, Int)
                 v1.values[idx.val] = v2
@@ -79,20 +82,20 @@ def eval_rfun(program: RfunProgram):
             else:
                 raise Exception('eval_e: unknown primitive: ', e)
         elif isinstance(e, If):
-            if eval_e(e.e1, env):
-                return eval_e(e.e2, env)
+            if (yield eval_e(e.e1, env)):
+                return (yield eval_e(e.e2, env))
             else:
-                return eval_e(e.e3, env)
+                return (yield eval_e(e.e3, env))
         elif isinstance(e, Funcall):
-            f_val = eval_e(e.fun, env)
+            f_val = yield eval_e(e.fun, env)
             assert isinstance(f_val, FunVal)
-            arg_vals = [eval_e(a, env) for a in e.args]
+            arg_vals = yield [eval_e(a, env) for a in e.args]
 
             extended_env = f_val.env.copy()
             for arg_name, arg_val in zip(f_val.args, arg_vals):
                 extended_env[arg_name] = arg_val
 
-            return eval_e(f_val.body, extended_env)
+            return (yield eval_e(f_val.body, extended_env))
 
         else:
             raise Exception('eval_e', e)
@@ -105,4 +108,6 @@ def eval_rfun(program: RfunProgram):
                              env,
                              d.body)
 
-    return eval_e(program.body, env)
+    # the body gets its own copy of env, since its lets change the dict it is
+    # given, and env is shared with the functions
+    return trampoline(eval_e(program.body, dict(env)))
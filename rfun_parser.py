@@ -2,59 +2,58 @@ from dataclasses import dataclass
 from collections import OrderedDict
 from typing import List, Set, Dict, Tuple
 from cs202_support.base_ast import AST, print_ast
-from lark import Lark
 from typed_rfun import *
 
 ##################################################
 # Abstract Syntax Trees: Rvec
 ##################################################
 
-@dataclass
+@dataclass(slots=True)
 class RfunExp(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Int(RfunExp):
     val: int
 
-@dataclass
+@dataclass(slots=True)
 class Bool(RfunExp):
     val: bool
 
-@dataclass
+@dataclass(slots=True)
 class Var(RfunExp):
     var: str
 
-@dataclass
+@dataclass(slots=True)
 class Let(RfunExp):
     x: str
     e1: RfunExp
     body: RfunExp
 
-@dataclass
+@dataclass(slots=True)
 class Prim(RfunExp):
     op: str
     args: List[RfunExp]
 
-@dataclass
+@dataclass(slots=True)
 class If(RfunExp):
     e1: RfunExp
     e2: RfunExp
     e3: RfunExp
 
-@dataclass
+@dataclass(slots=True)
 class Funcall(RfunExp):
     fun: RfunExp
     args: List[RfunExp]
 
-@dataclass
+@dataclass(slots=True)
 class RfunDef(AST):
     name: str
     args: List[Tuple[str, RfunType]]
     output_type: RfunType
     body: RfunExp
 
-@dataclass
+@dataclass(slots=True)
 class RfunProgram(AST):
     defs: List[RfunDef]
     body: RfunExp
@@ -64,7 +63,7 @@ class RfunProgram(AST):
 # Concrete Syntax Parser
 ##################################################
 
-_rfun_parser = Lark(r"""
+_rfun_grammar = r"""
     ?exp: NUMBER -> int_e
         | "True" -> true_e
         | "False" -> false_e
@@ -102,101 +101,117 @@ _rfun_parser = Lark(r"""
 
     %import common.WS
     %ignore WS
-    """, start='prog', parser='lalr')
+    """
+
+_rfun_parser = None
+
+def _get_parser():
+    """
+    Builds the LALR parser for the Rfun grammar the first time it is needed.
+    The parser builds the AST as it parses, using _RfunBuilder.
+    Lark saves the parse tables to a cache file in the temp directory, keyed
+    by a hash of the grammar text, the parser options and the Lark and Python
+    versions, so that later processes load the tables instead of building
+    them again.
+    """
+    global _rfun_parser
+    if _rfun_parser is None:
+        from lark import Lark
+        _rfun_parser = Lark(_rfun_grammar, start='prog', parser='lalr', cache=True,
+                            transformer=_RfunBuilder())
+    return _rfun_parser
 
 
 ##################################################
 # Pass #0: Parsing Concrete to Abstract Syntax
 ##################################################
 
+class _RfunBuilder:
+    """
+    Builds the AST during parsing. The LALR parser calls the method named
+    after each rule (or alias) as soon as it reduces the rule, passing the
+    rule's children, which have already been built. No parse tree is made.
+    """
+
+    # Types
+
+    def integer_t(self, children):
+        return IntT()
+
+    def boolean_t(self, children):
+        return BoolT()
+
+    def vector_t(self, children):
+        return VectorT(children)
+
+    def fun_t(self, children):
+        return FunT(children[:-1], children[-1])
+
+    # Definitions and programs
+
+    def typed_name(self, children):
+        name, t = children
+        return (str(name), t)
+
+    def def_args(self, children):
+        return children
+
+    def def_e(self, children):
+        name, args, output_type, body = children
+        return RfunDef(str(name), args, output_type, body)
+
+    def prog(self, children):
+        return RfunProgram(children[:-1], children[-1])
+
+    # Expressions
+
+    def int_e(self, children):
+        return Int(int(children[0]))
+
+    def var_e(self, children):
+        return Var(str(children[0]))
+
+    def true_e(self, children):
+        return Bool(True)
+
+    def false_e(self, children):
+        return Bool(False)
+
+    def plus_e(self, children):
+        return Prim('+', children)
+
+    def neg_e(self, children):
+        return Prim('neg', children)
+
+    def not_e(self, children):
+        return Prim('not', children)
+
+    def cmp_e(self, children):
+        e1, op, e2 = children
+        return Prim(str(op), [e1, e2])
+
+    def let_e(self, children):
+        x, e1, body = children
+        return Let(str(x), e1, body)
+
+    def if_e(self, children):
+        e1, e2, e3 = children
+        return If(e1, e2, e3)
+
+    def vector_ref_e(self, children):
+        return Prim('vectorRef', children)
+
+    def vector_set_e(self, children):
+        return Prim('vectorSet', children)
+
+    def vector_e(self, children):
+        return Prim('vector', children)
+
+    def funcall_e(self, children):
+        return Funcall(children[0], children[1:])
+
 def _parse(s: str) -> RfunProgram:
-    def bprog(p) -> RfunProgram:
-        assert p.data == 'prog'
-
-        defs = [bdef(d) for d in p.children[:-1]]
-        expr = bast(p.children[-1])
-
-        return RfunProgram(defs, expr)
-
-    def btype(t):
-        if t.data == 'integer_t':
-            return IntT()
-        elif t.data == 'boolean_t':
-            return BoolT()
-        elif t.data == 'vector_t':
-            arg_types = [btype(ta) for ta in t.children]
-            
-            return VectorT(arg_types)
-        elif t.data == 'fun_t':
-            arg_types = [btype(ta) for ta in t.children[:-1]]
-            output_type = btype(t.children[-1])
-            
-            return FunT(arg_types, output_type)
-        else:
-            raise Exception('unknown type:', t)
-
-    def btyped_name(tn):
-        assert tn.data == 'typed_name'
-
-        name, t = tn.children
-        return (str(name), btype(t))
-    
-    def bdef(d):
-        assert d.data == 'def_e'
-
-        name, args, output_type, body = d.children
-        assert args.data == 'def_args'
-        
-        return RfunDef(str(name),
-                       [btyped_name(a) for a in args.children],
-                       btype(output_type),
-                       bast(body))
-
-    def bast(e) -> RfunExp:
-        if e.data == 'int_e':
-            return Int(int(e.children[0]))
-        if e.data == 'var_e':
-            return Var(str(e.children[0]))
-        elif e.data == 'plus_e':
-            e1, e2 = e.children
-            return Prim('+', [bast(e1), bast(e2)])
-        elif e.data == 'neg_e':
-            e1 = e.children[0]
-            return Prim('neg', [bast(e1)])
-        elif e.data == 'let_e':
-            x, e1, body = e.children
-            return Let(str(x), bast(e1), bast(body))
-        elif e.data == 'if_e':
-            e1, e2, e3 = e.children
-            return If(bast(e1), bast(e2), bast(e3))
-        elif e.data == 'cmp_e':
-            e1, op, e2 = e.children
-            return Prim(str(op), [bast(e1), bast(e2)])
-        elif e.data == 'not_e':
-            e1 = e.children[0]
-            return Prim('not', [bast(e1)])
-        elif e.data == 'true_e':
-            return Bool(True)
-        elif e.data == 'false_e':
-            return Bool(False)
-        elif e.data == 'vector_ref_e':
-            e1, e2 = e.children
-            return Prim('vectorRef', [bast(e1), bast(e2)])
-        elif e.data == 'vector_set_e':
-            e1, e2, e3 = e.children
-            return Prim('vectorSet', [bast(e1), bast(e2), bast(e3)])
-        elif e.data == 'vector_e':
-            new_children = [bast(c) for c in e.children]
-            return Prim('vector', new_children)
-        elif e.data == 'funcall_e':
-            new_children = [bast(c) for c in e.children]
-            return Funcall(new_children[0], new_children[1:])
-        else:
-            raise Exception('parse', e)
-
-    parsed = _rfun_parser.parse(s)
-    program = bprog(parsed)
-    return program
+    return _get_parser().parse(s)
 
 def parse_rfun(s: str) -> RfunProgram:
     return _parse(s)
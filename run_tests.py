@@ -2,6 +2,8 @@ import os
 import traceback
 import sys
 import subprocess
+import tempfile
+import compiler
 from compiler import run_compiler
 from rfun_parser import parse_rfun
 from interpreter import eval_rfun
@@ -11,63 +13,155 @@ from cs202_support import eval_x86
 # You must compile the runtime first and place it in the parent directory
 
 run_gcc = False
-files = sorted(os.listdir('tests'))
-
-for arg in sys.argv[1:]:
-    if arg == '--run-gcc':
-        run_gcc = True
-    else:
-        # must be a filename with the test to run
-        files = [arg]
-
-for file_name in files:
-    if file_name.endswith('.rfun'):
-        with open('tests/' + file_name) as f:
-            print(f'Testing program {file_name}...')
-
-            try:
-                program = f.read()
-                ast = parse_rfun(program)
-                interpreter_result = eval_rfun(ast)
-            
-                x86_program = run_compiler(program, logging=False)
-                emu = eval_x86.X86Emulator(logging=False)
-                x86_output = emu.eval_program(x86_program)
-
-                if len(x86_output) == 1 and x86_output[0] == interpreter_result:
-                    print('Test passed')
-                else:
-                    print('Test failed! **************************************************')
-                    print('Interpreter result:', interpreter_result)
-                    print('Compiled x86 result:', x86_output)
-
-                if run_gcc:
-                    asm_file_name = 'tests/' + file_name + '.s'
-                    with open(asm_file_name, 'w') as output_file:
-                        output_file.write(x86_program)
-                    
-                    # run gcc to compile the binary
-                    gcc_result = subprocess.run(["gcc", "-g", "../runtime.o", asm_file_name],
-                                                text=True, capture_output=True)
-                    print('GCC output:', gcc_result.stdout)
-
-                    # run the binary
-                    binary_result = subprocess.run(["./a.out"], text=True, capture_output=True)
-                    print('Binary output:', binary_result.stdout)
-
-                    if binary_result.stdout == str(int(interpreter_result)): # hack for types
-                        print('Binary test passed')
+
+# Pass the --cache option to keep compiled code in the compile_cache directory,
+# so that programs that have not changed are not compiled again. With
+# --incremental as well, the code of each function is cached too, and only
+# functions that have changed are compiled again
+
+cache_dir = None
+incremental = False
+
+# Pass --workers N to also compile each program with the parallel backend, in
+# N processes, and check that it produces the same code as the serial one
+
+workers = None
+
+# Pass --old-tests to run the programs in old_tests instead of tests
+
+test_dir = 'tests'
+
+# Emulated programs that run longer than this many seconds (for example, a
+# miscompiled program that loops forever) fail instead of hanging the sweep
+time_limit = 30
+
+def check_cache(program: str) -> bool:
+    """
+    Compiles a program without a cache and twice with an empty one (once to
+    fill it, once to read it back), with the default inlining limits and with
+    inlining turned off.
+    :param program: An Rfun program, as a string
+    :return: Whether the cached code is always the same as the uncached code
+    """
+    default_max_size = compiler.inline_max_size
+    try:
+        with tempfile.TemporaryDirectory() as test_cache_dir:
+            for max_size in [default_max_size, 0]:
+                compiler.inline_max_size = max_size
+                uncached_program = run_compiler(program, logging=False)
+                for i in range(2):
+                    if run_compiler(program, logging=False, cache_dir=test_cache_dir) != uncached_program:
+                        return False
+        return True
+    finally:
+        compiler.inline_max_size = default_max_size
+
+def main():
+    global run_gcc, cache_dir, incremental, workers, test_dir
+
+    args = iter(sys.argv[1:])
+    files = None
+    for arg in args:
+        if arg == '--run-gcc':
+            run_gcc = True
+        elif arg == '--old-tests':
+            test_dir = 'old_tests'
+        elif arg == '--cache':
+            cache_dir = 'compile_cache'
+        elif arg == '--incremental':
+            cache_dir = 'compile_cache'
+            incremental = True
+        elif arg == '--workers':
+            workers = int(next(args))
+        else:
+            # must be a filename with the test to run
+            files = [arg]
+
+    if files is None:
+        files = sorted(os.listdir(test_dir))
+
+    for file_name in files:
+        if file_name.endswith('.rfun'):
+            with open(test_dir + '/' + file_name) as f:
+                print(f'Testing program {file_name}...')
+
+                try:
+                    program = f.read()
+                    ast = parse_rfun(program)
+                    interpreter_result = eval_rfun(ast)
+
+                    x86_program = run_compiler(program, logging=False, cache_dir=cache_dir,
+                                               incremental=incremental)
+                    emu = eval_x86.X86Emulator(logging=False, time_limit=time_limit)
+                    x86_output = emu.eval_program(x86_program)
+
+                    # the block-compiling engine must give the same output
+                    compiled_emu = eval_x86.X86Emulator(logging=False, compiled=True,
+                                                       time_limit=time_limit)
+                    compiled_output = compiled_emu.eval_program(x86_program)
+
+                    # running the passes one at a time must give the same code as
+                    # running them fused
+                    fused_program = run_compiler(program, logging=False)
+                    unfused_program = run_compiler(program, logging=False, fused=False)
+
+                    if workers is not None:
+                        parallel_program = run_compiler(program, logging=False, max_workers=workers)
+                    else:
+                        parallel_program = x86_program
+
+                    if not check_cache(program):
+                        print('Test failed! **************************************************')
+                        print('The compile cache produced different code')
+                    elif unfused_program != fused_program:
+                        print('Test failed! **************************************************')
+                        print('The fused passes produced different code than the passes run one at a time')
+                    elif parallel_program != x86_program:
+                        print('Test failed! **************************************************')
+                        print('The parallel backend produced different code')
+                    elif compiled_output != x86_output:
+                        print('Test failed! **************************************************')
+                        print('Compiled x86 result:', x86_output)
+                        print('Compiled x86 result (compiled engine):', compiled_output)
+                    elif len(x86_output) == 1 and x86_output[0] == interpreter_result:
+                        print('Test passed')
                     else:
-                        print('Binary test failed! ************************************************')
+                        print('Test failed! **************************************************')
                         print('Interpreter result:', interpreter_result)
-                        print('Binary x86 stdout:', binary_result.stdout)
-                        print('Binary x86 stderr:', binary_result.stderr)
+                        print('Compiled x86 result:', x86_output)
+
+                    if run_gcc:
+                        asm_file_name = test_dir + '/' + file_name + '.s'
+                        with open(asm_file_name, 'w') as output_file:
+                            output_file.write(x86_program)
+
+                        # run gcc to compile the binary
+                        gcc_result = subprocess.run(["gcc", "-g", "../runtime.o", asm_file_name],
+                                                    text=True, capture_output=True)
+                        print('GCC output:', gcc_result.stdout)
+
+                        # run the binary
+                        binary_result = subprocess.run(["./a.out"], text=True, capture_output=True)
+                        print('Binary output:', binary_result.stdout)
+
+                        if binary_result.stdout == str(int(interpreter_result)): # hack for types
+                            print('Binary test passed')
+                        else:
+                            print('Binary test failed! ************************************************')
+                            print('Interpreter result:', interpreter_result)
+                            print('Binary x86 stdout:', binary_result.stdout)
+                            print('Binary x86 stderr:', binary_result.stderr)
+
+                        os.remove(asm_file_name)
+                        os.remove('a.out')
 
-                    os.remove(asm_file_name)
-                    os.remove('a.out')
+                    print()
 
-                print()
+                except:
+                    print('Test failed with error! **************************************************')
+                    traceback.print_exception(*sys.exc_info())
 
-            except:
-                print('Test failed with error! **************************************************')
-                traceback.print_exception(*sys.exc_info())
+# the parallel backend's worker processes may import this file, so the
+# tests only run when it is the main script
+if __name__ == '__main__':
+    main()
@@ -6,27 +6,52 @@ from typing import List, Set, Dict, Tuple
 # Types: Typed Rvec
 ##################################################
 
-@dataclass
-class RfunType(RType):
-    pass
-
-@dataclass
+class InternedType(type):
+    """
+    Metaclass of the types. Calling a type class returns the one canonical
+    instance with the given fields, creating it the first time, so types that
+    are structurally equal are the same object. Types compare and hash by
+    identity (their classes use eq=False), which makes equality checks O(1)
+    and types cheap dict keys. The canonical instances must not be changed.
+    """
+    def __call__(cls, *args, **kwargs):
+        if kwargs:
+            args = args + tuple(kwargs[name] for name in cls.__match_args__[len(args):])
+
+        # fields are canonical types, or lists of them
+        key = (cls,) + tuple(tuple(a) if isinstance(a, list) else a for a in args)
+        t = cls.instances.get(key)
+        if t is None:
+            # setdefault keeps one instance if two threads race here
+            t = cls.instances.setdefault(key, super().__call__(*[list(a) if isinstance(a, list) else a
+                                                                  for a in args]))
+        return t
+
+@dataclass(slots=True, eq=False)
+class RfunType(RType, metaclass=InternedType):
+    instances = {}
+
+    def __reduce__(self):
+        # unpickling goes through the metaclass too, and finds the canonical copy
+        return type(self), tuple(getattr(self, name) for name in self.__match_args__)
+
+@dataclass(slots=True, eq=False)
 class IntT(RfunType):
     pass
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class BoolT(RfunType):
     pass
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class VoidT(RfunType):
     pass
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class VectorT(RfunType):
     types: List[RfunType]
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class FunT(RfunType):
     arg_types: List[RfunType]
     return_type: RfunType
@@ -36,69 +61,69 @@ class FunT(RfunType):
 # Abstract Syntax Trees: Typed RVec
 ##################################################
 
-@dataclass
+@dataclass(slots=True)
 class RfunExpT(AST):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class IntTE(RfunExpT):
     val: int
 
-@dataclass
+@dataclass(slots=True)
 class BoolTE(RfunExpT):
     val: bool
 
-@dataclass
+@dataclass(slots=True)
 class VoidTE(RfunExpT):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class VarTE(RfunExpT):
     var: str
     typ: RfunType
 
-@dataclass
+@dataclass(slots=True)
 class GlobalValTE(RfunExpT):
     var: str
 
-@dataclass
+@dataclass(slots=True)
 class LetTE(RfunExpT):
     x: str
     e1: RfunExpT
     body: RfunExpT
 
-@dataclass
+@dataclass(slots=True)
 class PrimTE(RfunExpT):
     op: str
     args: List[RfunExpT]
     typ: RfunType
 
-@dataclass
+@dataclass(slots=True)
 class IfTE(RfunExpT):
     e1: RfunExpT
     e2: RfunExpT
     e3: RfunExpT
     typ: RfunType
 
-@dataclass
+@dataclass(slots=True)
 class FuncallTE(RfunExpT):
     fun: RfunExpT
     args: List[RfunExpT]
     typ: RfunType
 
-@dataclass
+@dataclass(slots=True)
 class FunRefTE(RfunExpT):
     name: str
     typ: FunT
 
-@dataclass
+@dataclass(slots=True)
 class RfunDefT(AST):
     name: str
     args: List[Tuple[str, RfunType]]
     output_type: RfunType
     body: RfunExpT
 
-@dataclass
+@dataclass(slots=True)
 class RfunProgramT(AST):
     defs: List[RfunDefT]
     body: RfunExpT